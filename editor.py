@@ -4,6 +4,7 @@ import sys
 import pygame
 from pygame.math import Vector2
 
+from scripts.journal import JOURNAL_EXT, EditJournal
 from scripts.tilemap import Tilemap
 from scripts.utils import load_images
 
@@ -35,6 +36,10 @@ class Editor:
         except FileNotFoundError:
             raise
 
+        # Edits since the last save are autosaved to the journal
+        self.journal = EditJournal(self.tilemap, "map.json" + JOURNAL_EXT)
+        self.journal.recover()
+
         self.scroll = [0, 0]
 
         self.tile_list = list(self.assets)
@@ -45,22 +50,122 @@ class Editor:
         self.right_clicking = False
         self.shift = False
         self.ongrid = True
+        # Corner tile of the rectangle being dragged with shift held, and
+        # whether it erases (right button) or fills (left button)
+        self.rect_start = None
+        self.rect_erase = False
+
+        # Map rendered without any overlays, and what it and the overlays
+        # were last drawn for, see render
+        self.scene = pygame.Surface(self.display.get_size())
+        self.scene_key = None
+        self.overlay_key = None
+        self.overlay_rects = []
+        self.preview_cache = {}
+
+    def preview(self):
+        # Translucent copy of the selected tile, made once per tile
+        key = (self.tile_list[self.tile_group], self.tile_variant)
+        img = self.preview_cache.get(key)
+        if img is None:
+            img = self.preview_cache[key] = self.assets[key[0]][key[1]].copy()
+            img.set_alpha(100)
+
+        return img
+
+    def render(self, render_scroll, tile_pos, mpos):
+        # Does nothing while the camera, cursor and map stay the same. The
+        # map is only redrawn when it or the camera changed, otherwise just
+        # the areas under the old and new overlays are sent to the screen.
+        scene_key = (render_scroll, self.tilemap.version)
+        full = scene_key != self.scene_key
+        if full:
+            self.scene.fill((0, 0, 0))
+            self.tilemap.render(self.scene, offset=render_scroll)
+            self.scene_key = scene_key
+
+        current_tile_img = self.preview()
+        if self.ongrid:
+            cursor_pos = Vector2(tile_pos) * self.tilemap.tile_size - Vector2(
+                self.scroll
+            )
+        else:
+            cursor_pos = Vector2(mpos)
+        selection_rect = None
+        if self.rect_start:
+            selection_rect = pygame.Rect(
+                min(self.rect_start[0], tile_pos[0]) * self.tilemap.tile_size
+                - render_scroll[0],
+                min(self.rect_start[1], tile_pos[1]) * self.tilemap.tile_size
+                - render_scroll[1],
+                (abs(tile_pos[0] - self.rect_start[0]) + 1) * self.tilemap.tile_size,
+                (abs(tile_pos[1] - self.rect_start[1]) + 1) * self.tilemap.tile_size,
+            )
+
+        overlay_key = (
+            tuple(cursor_pos),
+            current_tile_img,
+            selection_rect and tuple(selection_rect),
+            self.rect_erase,
+        )
+        if not full and overlay_key == self.overlay_key:
+            return
+        self.overlay_key = overlay_key
+
+        self.display.blit(self.scene, (0, 0))
+        # Blits truncate float positions, one pixel of slack covers that
+        overlay_rects = [
+            current_tile_img.get_rect(topleft=cursor_pos).inflate(2, 2),
+            self.display.blit(current_tile_img, (5, 5)),
+        ]
+        self.display.blit(current_tile_img, cursor_pos)
+        if selection_rect:
+            overlay_rects.append(
+                pygame.draw.rect(
+                    self.display,
+                    (255, 0, 0) if self.rect_erase else (255, 255, 255),
+                    selection_rect,
+                    1,
+                )
+            )
+
+        scale = self.screen.get_width() // self.display.get_width()
+        if full or self.screen.get_size() != (
+            self.display.get_width() * scale,
+            self.display.get_height() * scale,
+        ):
+            self.screen.blit(
+                pygame.transform.scale(self.display, self.screen.get_size()), (0, 0)
+            )
+            pygame.display.update()
+        else:
+            screen_rects = []
+            for rect in self.overlay_rects + overlay_rects:
+                rect = rect.clip(self.display.get_rect())
+                if not rect.width or not rect.height:
+                    continue
+                screen_rect = pygame.Rect(
+                    rect.x * scale,
+                    rect.y * scale,
+                    rect.width * scale,
+                    rect.height * scale,
+                )
+                self.screen.blit(
+                    pygame.transform.scale(
+                        self.display.subsurface(rect), screen_rect.size
+                    ),
+                    screen_rect,
+                )
+                screen_rects.append(screen_rect)
+            pygame.display.update(screen_rects)
+        self.overlay_rects = overlay_rects
 
     def run(self):
         while True:
-            self.display.fill((0, 0, 0))
-
             self.scroll[0] += (self.movement[1] - self.movement[0]) * RENDER_SCALE
             self.scroll[1] += (self.movement[3] - self.movement[2]) * RENDER_SCALE
             render_scroll = (int(self.scroll[0]), int(self.scroll[1]))
 
-            self.tilemap.render(self.display, offset=render_scroll)
-
-            current_tile_img = self.assets[self.tile_list[self.tile_group]][
-                self.tile_variant
-            ].copy()
-            current_tile_img.set_alpha(100)
-
             mpos = pygame.mouse.get_pos()
             mpos = (mpos[0] / RENDER_SCALE, mpos[1] / RENDER_SCALE)
 
@@ -68,52 +173,40 @@ class Editor:
                 int((mpos[0] + self.scroll[0]) // self.tilemap.tile_size),
                 int((mpos[1] + self.scroll[1]) // self.tilemap.tile_size),
             )
-            if self.ongrid:
-                self.display.blit(
-                    current_tile_img,
-                    Vector2(tile_pos) * self.tilemap.tile_size - Vector2(self.scroll),
-                )
-            else:
-                self.display.blit(current_tile_img, mpos)
 
             if self.clicking and self.ongrid:
-                self.tilemap.tilemap[f"{tile_pos[0]};{tile_pos[1]}"] = {
-                    "type": self.tile_list[self.tile_group],
-                    "variant": self.tile_variant,
-                    "pos": tile_pos,
-                }
+                self.tilemap.set_tile(
+                    tile_pos, self.tile_list[self.tile_group], self.tile_variant
+                )
             if self.right_clicking:
-                tile_loc = f"{tile_pos[0]};{tile_pos[1]}"
-                if tile_loc in self.tilemap.tilemap:
-                    del self.tilemap.tilemap[tile_loc]
-
-                for tile in self.tilemap.offgrid_tiles.copy():
-                    tile_img = self.assets[tile["type"]][tile["variant"]]
-                    tile_r = pygame.Rect(
-                        tile["pos"][0] - self.scroll[0],
-                        tile["pos"][1] - self.scroll[1],
-                        tile_img.get_width(),
-                        tile_img.get_height(),
-                    )
-                    if tile_r.collidepoint(mpos):
-                        self.tilemap.offgrid_tiles.remove(tile)
-
-            self.display.blit(current_tile_img, (5, 5))
+                self.tilemap.remove_tile(tile_pos)
+
+                for key in self.tilemap.offgrid_at(
+                    Vector2(mpos) + Vector2(self.scroll)
+                ):
+                    self.tilemap.remove_offgrid(key)
+
+            self.tilemap.update_autotile()
 
             for event in pygame.event.get():
                 if event.type == pygame.MOUSEBUTTONDOWN:
-                    if event.button == 1:
+                    if self.shift and event.button in (1, 3):
+                        # Shift-drag fills or erases a whole rectangle
+                        if event.button == 3 or self.ongrid:
+                            self.rect_start = tile_pos
+                            self.rect_erase = event.button == 3
+                    elif event.button == 1:
                         self.clicking = True
                         if not self.ongrid:
                             pos = Vector2(mpos) + Vector2(self.scroll)
-                            self.tilemap.offgrid_tiles.append(
+                            self.tilemap.add_offgrid(
                                 {
                                     "type": self.tile_list[self.tile_group],
                                     "variant": self.tile_variant,
                                     "pos": (pos[0], pos[1]),
                                 }
                             )
-                    if event.button == 3:
+                    elif event.button == 3:
                         self.right_clicking = True
                     if self.shift:
                         if event.button == 4:
@@ -137,10 +230,26 @@ class Editor:
                             self.tile_variant = 0
 
                 if event.type == pygame.MOUSEBUTTONUP:
+                    if self.rect_start and event.button == (
+                        3 if self.rect_erase else 1
+                    ):
+                        if self.rect_erase:
+                            self.tilemap.erase_rect(self.rect_start, tile_pos)
+                        else:
+                            self.tilemap.fill_rect(
+                                self.rect_start,
+                                tile_pos,
+                                self.tile_list[self.tile_group],
+                                self.tile_variant,
+                            )
+                        self.rect_start = None
                     if event.button == 1:
                         self.clicking = False
                     if event.button == 3:
                         self.right_clicking = False
+                    if not self.clicking and not self.right_clicking:
+                        self.tilemap.update_autotile()
+                        self.journal.end()
 
                 # Had to duplicate this code for compatibility issues
                 # while scrolling variants
@@ -158,6 +267,9 @@ class Editor:
                 if event.type == pygame.QUIT:
                     self.quit()
 
+                if event.type == pygame.WINDOWEXPOSED:
+                    self.scene_key = None
+
                 if event.type == pygame.KEYDOWN:
                     if event.key == pygame.K_a:
                         self.movement[0] = True
@@ -172,7 +284,9 @@ class Editor:
                         self.ongrid ^= True
 
                     if event.key == pygame.K_o:
+                        self.journal.end()
                         self.tilemap.save("map.json")
+                        self.journal.truncate()
 
                     if event.key == pygame.K_LSHIFT:
                         self.shift = True
@@ -180,8 +294,22 @@ class Editor:
                     if event.key == pygame.K_ESCAPE:
                         self.quit()
 
+                    if event.key == pygame.K_f and self.ongrid:
+                        self.tilemap.flood_fill(
+                            tile_pos, self.tile_list[self.tile_group], self.tile_variant
+                        )
+                        self.tilemap.update_autotile()
+                        self.journal.end()
+
                     if event.key == pygame.K_t:
                         self.tilemap.autotile()
+                        self.journal.end()
+
+                    if event.mod & pygame.KMOD_CTRL:
+                        if event.key == pygame.K_z:
+                            self.journal.undo()
+                        if event.key == pygame.K_y:
+                            self.journal.redo()
 
                 if event.type == pygame.KEYUP:
                     if event.key == pygame.K_a:
@@ -195,10 +323,7 @@ class Editor:
                     if event.key == pygame.K_LSHIFT:
                         self.shift = False
 
-            self.screen.blit(
-                pygame.transform.scale(self.display, self.screen.get_size()), (0, 0)
-            )
-            pygame.display.update()
+            self.render(render_scroll, tile_pos, mpos)
             self.clock.tick(60)
 
     @staticmethod
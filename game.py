@@ -1,327 +1,395 @@
-import math
+import argparse
+import collections
 import random
 import os
 import sys
+import time
 
 import pygame
 
 from scripts.clouds import Clouds
-from scripts.entities import Player, Enemy
-from scripts.particles import Particle
-from scripts.sparks import Spark
-from scripts.tilemap import Tilemap
-from scripts.utils import load_image, load_images, Animation
+from scripts.profiler import profiler
+from scripts.replay import Replay
+from scripts.snapshot import SnapshotRing
+from scripts.world import (
+    INPUT_DASH,
+    INPUT_JUMP,
+    INPUT_LEFT,
+    INPUT_RIGHT,
+    MAPS_PATH,
+    STEP_RATE,
+    NullSound,
+    World,
+    load_assets,
+)
+
+# How the drop shadow around the foreground is drawn: "exact" builds it from
+# a mask of the whole rendered frame, "cached" composites outlines baked once
+# per tile chunk and per sprite, which is much cheaper per frame but may
+# darken the spots where two shadows overlap a bit more
+OUTLINE_EXACT = "exact"
+OUTLINE_CACHED = "cached"
+
+# Simulation steps run per rendered frame at most, so a long stall doesn't
+# make the game spend the next frames catching up
+MAX_STEPS_PER_FRAME = 5
+# Frames between exports of the profiler history, see Game.profile_path
+PROFILE_EXPORT_EVERY = 300
 
 
 class Game:
-    def __init__(self, width: int = 640, height: int = 480):
+    def __init__(
+        self,
+        width: int = 640,
+        height: int = 480,
+        interpolate=True,
+        outline=OUTLINE_CACHED,
+        stream=False,
+        profile_path=None,
+        audio=True,
+        level=0,
+        maps_path=MAPS_PATH,
+        seed=None,
+        record_path=None,
+        replay=None,
+        speed=1,
+        rewind=True,
+    ):
         pygame.init()
         pygame.display.set_caption("Ninja game")
         self.screen = pygame.display.set_mode((width, height))
         self.display = pygame.Surface((width // 2, height // 2), pygame.SRCALPHA)
         self.display2 = pygame.Surface((width // 2, height // 2))
+        self.outline = outline
+        # Layer the spark outlines are drawn on, pygame.draw doesn't blend
+        self.outline_layer = pygame.Surface(self.display.get_size(), pygame.SRCALPHA)
 
         self.clock = pygame.time.Clock()
         self.movement = [False, False]
-
-        self.assets = {
-            "decor": load_images(os.path.join("tiles", "decor")),
-            "large_decor": load_images(os.path.join("tiles", "large_decor")),
-            "grass": load_images(os.path.join("tiles", "grass")),
-            "stone": load_images(os.path.join("tiles", "stone")),
-            "player": load_image(os.path.join("entities", "player.png")),
-            "background": load_image("background.png"),
-            "clouds": load_images("clouds"),
-            "player/idle": Animation(
-                load_images(os.path.join("entities", "player", "idle")), img_dur=6
-            ),
-            "player/run": Animation(
-                load_images(os.path.join("entities", "player", "run")), img_dur=4
-            ),
-            "player/jump": Animation(
-                load_images(os.path.join("entities", "player", "jump"))
-            ),
-            "player/slide": Animation(
-                load_images(os.path.join("entities", "player", "slide"))
-            ),
-            "player/wall_slide": Animation(
-                load_images(os.path.join("entities", "player", "wall_slide"))
-            ),
-            "particle/leaf": Animation(
-                load_images(os.path.join("particles", "leaf")), img_dur=20, loop=False
-            ),
-            "particle/particle": Animation(
-                load_images(os.path.join("particles", "particle")),
-                img_dur=6,
-                loop=False,
-            ),
-            "enemy/idle": Animation(
-                load_images(os.path.join("entities", "enemy", "idle")), img_dur=6
-            ),
-            "enemy/run": Animation(
-                load_images(os.path.join("entities", "enemy", "run")), img_dur=4
-            ),
-            "gun": load_image("gun.png"),
-            "projectile": load_image("projectile.png"),
-        }
-        self.sfx = {
-            "jump": pygame.mixer.Sound(os.path.join("data", "sfx", "jump.wav")),
-            "dash": pygame.mixer.Sound(os.path.join("data", "sfx", "dash.wav")),
-            "hit": pygame.mixer.Sound(os.path.join("data", "sfx", "hit.wav")),
-            "shoot": pygame.mixer.Sound(os.path.join("data", "sfx", "shoot.wav")),
-            "ambience": pygame.mixer.Sound(os.path.join("data", "sfx", "ambience.wav")),
-        }
+        # Presses since the last simulation step
+        self.pressed = 0
+        # Draw entities between their last two simulation positions
+        self.interpolate = interpolate
+        # Frame timings are exported there regularly, .csv or .json, and
+        # shown on screen while F3 is toggled on
+        self.profile_path = profile_path
+        self.show_profile = False
+        # Steps are fed from replay instead of the keyboard when it is set,
+        # speed times faster than real time
+        self.replay = replay
+        self.speed = speed
+        if replay is not None:
+            seed = replay.seed
+            level = replay.level
+
+        self.assets = load_assets()
+        # Without audio nothing is played, for benchmarks and batch runs
+        if audio:
+            self.sfx = {
+                "jump": pygame.mixer.Sound(os.path.join("data", "sfx", "jump.wav")),
+                "dash": pygame.mixer.Sound(os.path.join("data", "sfx", "dash.wav")),
+                "hit": pygame.mixer.Sound(os.path.join("data", "sfx", "hit.wav")),
+                "shoot": pygame.mixer.Sound(os.path.join("data", "sfx", "shoot.wav")),
+                "ambience": pygame.mixer.Sound(
+                    os.path.join("data", "sfx", "ambience.wav")
+                ),
+            }
+        else:
+            self.sfx = collections.defaultdict(NullSound)
         self.sfx["ambience"].set_volume(0.2)
         self.sfx["dash"].set_volume(0.3)
         self.sfx["shoot"].set_volume(0.4)
         self.sfx["jump"].set_volume(0.7)
         self.sfx["hit"].set_volume(0.8)
 
-        self.clouds = Clouds(self.assets["clouds"], count=16)
-        self.player = Player(self, (50, 50), (8, 15))
-        self.tilemap = Tilemap(self, tile_size=16)
-
-        self.level = 0
-        self.load_level(self.level)
+        self.world = World(
+            self.assets,
+            self.sfx,
+            level=level,
+            stream=stream,
+            maps_path=maps_path,
+            seed=seed,
+        )
+        # Randomness that only changes the looks, kept apart from world.rng
+        # so rendering never changes how the simulation plays out
+        self.rng = random.Random(self.world.seed)
+        self.clouds = Clouds(self.assets["clouds"], count=16, rng=self.rng)
+
+        # Every step's inputs are recorded and saved to record_path on quit
+        self.record_path = record_path
+        self.recording = Replay(self.world.seed, level) if record_path else None
+        # A snapshot of the world before every step, popped one per step
+        # while R is held to rewind. None without rewind, for benchmarks.
+        self.snapshots = SnapshotRing() if rewind else None
+        self.rewinding = False
 
         self.scroll = [0, 0]
-        self.dead = 0
-
-        self.screenshake = 0
+        self.prev_scroll = [0, 0]
+
+    def inputs(self):
+        inputs = self.pressed
+        if self.movement[0]:
+            inputs |= INPUT_LEFT
+        if self.movement[1]:
+            inputs |= INPUT_RIGHT
+
+        return inputs
+
+    def handle_events(self):
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                self.quit()
+            if event.type == pygame.KEYDOWN:
+                if event.key == pygame.K_LEFT:
+                    self.movement[0] = True
+                if event.key == pygame.K_RIGHT:
+                    self.movement[1] = True
+                if event.key == pygame.K_UP:
+                    self.pressed |= INPUT_JUMP
+                if event.key == pygame.K_x:
+                    self.pressed |= INPUT_DASH
+                if event.key == pygame.K_r:
+                    self.rewinding = True
+                if event.key == pygame.K_F3:
+                    self.show_profile ^= True
+                if (
+                    event.key == pygame.K_c and pygame.key.get_mods() & pygame.K_LCTRL
+                ) or event.key == pygame.K_ESCAPE:
+                    self.quit()
 
-    def load_level(self, map_id):
-        self.tilemap.load(os.path.join("data", "maps", f"{map_id}.json"))
-        self.leaf_spawners = []
-        for tree in self.tilemap.extract([("large_decor", 2)], keep=True):
-            self.leaf_spawners.append(
-                pygame.Rect(4 + tree["pos"][0], 4 + tree["pos"][1], 23, 13)
+            if event.type == pygame.KEYUP:
+                if event.key == pygame.K_LEFT:
+                    self.movement[0] = False
+                if event.key == pygame.K_RIGHT:
+                    self.movement[1] = False
+                if event.key == pygame.K_r:
+                    self.rewinding = False
+
+    def step(self):
+        inputs = None
+        if self.replay is not None:
+            if self.world.frame == len(self.replay):
+                ok = self.world.state_hash() == self.replay.state_hash
+                print(f"replay finished, {'ok' if ok else 'state MISMATCH'}")
+                self.quit()
+            inputs = self.replay.inputs[self.world.frame]
+        elif self.rewinding and self.snapshots is not None:
+            snapshot = self.snapshots.pop()
+            if snapshot is not None:
+                self.world.restore(snapshot)
+                # The recording goes on from the restored step
+                if self.recording is not None:
+                    del self.recording.inputs[self.world.frame :]
+        else:
+            inputs = self.inputs()
+
+        if inputs is not None:
+            if self.recording is not None:
+                self.recording.record(inputs)
+
+            if self.snapshots is not None:
+                self.snapshots.push(self.world.snapshot())
+            self.world.step(inputs)
+        self.pressed = 0
+
+        self.prev_scroll = self.scroll.copy()
+        player = self.world.player
+        self.scroll[0] += (
+            player.rect().centerx - self.display.get_width() / 2 - self.scroll[0]
+        ) / 30
+        self.scroll[1] += (
+            player.rect().centery - self.display.get_height() / 2 - self.scroll[1]
+        ) / 30
+
+        self.world.tilemap.focus(
+            pygame.Rect(
+                int(self.scroll[0]), int(self.scroll[1]), *self.display.get_size()
             )
+        )
 
-        self.enemies = []
-        for spawner in self.tilemap.extract([("spawners", 0), ("spawners", 1)]):
-            if spawner["variant"] == 0:
-                self.player.pos = spawner["pos"]
-                self.player.air_time = 0
-            else:
-                self.enemies.append(Enemy(self, spawner["pos"], (8, 15)))
+        self.clouds.update()
 
-        self.particles = []
-        self.projectiles = []
-        self.sparks = []
-        self.dead = 0
-        self.transition = -30
+    def render_scene(self, surf, render_scroll, alpha, outline_only=False):
+        world = self.world
 
-    def run(self):
-        pygame.mixer.music.load(os.path.join("data", "music.wav"))
-        pygame.mixer.music.set_volume(0.5)
-        pygame.mixer.music.play(-1)
+        with profiler.phase("outline" if outline_only else "tiles"):
+            world.tilemap.render(surf, offset=render_scroll, outline_only=outline_only)
 
-        self.sfx["ambience"].play(-1)
+        with profiler.phase("outline" if outline_only else "entities"):
+            for enemy in world.enemies:
+                enemy.render(
+                    surf, enemy.render_offset(render_scroll, alpha), outline_only
+                )
 
-        while True:
-            self.display.fill((0, 0, 0, 0))
-            self.display2.blit(self.assets["background"], (0, 0))
+            if not world.dead:
+                world.player.render(
+                    surf, world.player.render_offset(render_scroll, alpha), outline_only
+                )
+
+            world.projectiles.render(
+                surf, offset=render_scroll, outline_only=outline_only
+            )
 
-            self.screenshake = max(0, self.screenshake - 1)
+    def render(self, alpha=1.0):
+        world = self.world
+        profiler.count("enemies", len(world.enemies))
+        profiler.count("particles", len(world.particles))
+        profiler.count("sparks", len(world.sparks))
+        profiler.count("projectiles", len(world.projectiles))
 
-            if not self.enemies:
-                self.transition += 1
-                if self.transition > 30:
-                    self.level = min(
-                        self.level + 1,
-                        len(os.listdir(os.path.join("data", "maps"))) - 1,
-                    )
-                    self.load_level(self.level)
-            if self.transition < 0:
-                self.transition += 1
-
-            if self.dead:
-                self.dead += 1
-                if self.dead >= 10:
-                    self.transition = min(30, self.transition + 1)
-                if self.dead > 40:
-                    self.load_level(self.level)
-
-            self.scroll[0] += (
-                self.player.rect().centerx
-                - self.display.get_width() / 2
-                - self.scroll[0]
-            ) / 30
-            self.scroll[1] += (
-                self.player.rect().centery
-                - self.display.get_height() / 2
-                - self.scroll[1]
-            ) / 30
-            render_scroll = (int(self.scroll[0]), int(self.scroll[1]))
-
-            for rect in self.leaf_spawners:
-                if random.random() * 49999 < rect.width * rect.height:
-                    pos = (
-                        rect.x + random.random() * rect.width,
-                        rect.y + random.random() * rect.height,
-                    )
-                    self.particles.append(
-                        Particle(
-                            self,
-                            "leaf",
-                            pos,
-                            velocity=[-0.1, 0.2],
-                            frame=random.randint(0, 20),
-                        )
-                    )
+        render_scroll = (
+            int(self.prev_scroll[0] + (self.scroll[0] - self.prev_scroll[0]) * alpha),
+            int(self.prev_scroll[1] + (self.scroll[1] - self.prev_scroll[1]) * alpha),
+        )
 
-            self.clouds.update()
+        with profiler.phase("background"):
+            self.display.fill((0, 0, 0, 0))
+            self.display2.blit(self.assets["background"], (0, 0))
             self.clouds.render(self.display2, render_scroll)
 
-            self.tilemap.render(self.display, offset=render_scroll)
+        if self.outline == OUTLINE_CACHED:
+            self.render_scene(self.display2, render_scroll, alpha, outline_only=True)
+            with profiler.phase("outline"):
+                if len(world.sparks):
+                    self.outline_layer.fill((0, 0, 0, 0))
+                    world.sparks.render(
+                        self.outline_layer, offset=render_scroll, outline_only=True
+                    )
+                    self.display2.blit(self.outline_layer, (0, 0))
 
-            for enemy in self.enemies.copy():
-                kill = enemy.update(self.tilemap, (0, 0))
-                enemy.render(self.display, render_scroll)
-                if kill:
-                    self.enemies.remove(enemy)
+        self.render_scene(self.display, render_scroll, alpha)
+        with profiler.phase("sparks"):
+            world.sparks.render(self.display, offset=render_scroll)
 
-            if not self.dead:
-                self.player.update(
-                    self.tilemap, (self.movement[1] - self.movement[0], 0)
-                )
-                self.player.render(self.display, offset=render_scroll)
-
-            # [[x, y], direction, timer]
-            for projectile in self.projectiles.copy():
-                projectile[0][0] += projectile[1]
-                projectile[2] += 1
-                img = self.assets["projectile"]
-                self.display.blit(
-                    img,
-                    (
-                        projectile[0][0] - img.get_width() / 2 - render_scroll[0],
-                        projectile[0][1] - img.get_height() / 2 - render_scroll[1],
-                    ),
+        if self.outline == OUTLINE_EXACT:
+            with profiler.phase("outline"):
+                display_mask = pygame.mask.from_surface(self.display)
+                display_silhouette = display_mask.to_surface(
+                    setcolor=(0, 0, 0, 180), unsetcolor=(0, 0, 0, 0)
                 )
-                if self.tilemap.solid_check(projectile[0]):
-                    self.projectiles.remove(projectile)
-                    for _ in range(4):
-                        self.sparks.append(
-                            Spark(
-                                projectile[0],
-                                random.random()
-                                - 0.5
-                                + (math.pi if projectile[1] > 0 else 0),
-                                2 + random.random(),
-                            )
-                        )
-                elif projectile[2] > 360:
-                    self.projectiles.remove(projectile)
-                elif abs(self.player.dashing) < 50:
-                    if self.player.rect().collidepoint(projectile[0]):
-                        self.projectiles.remove(projectile)
-                        self.sfx["hit"].play()
-                        self.dead += 1
-                        self.screenshake = max(16, self.screenshake)
-                        for _ in range(30):
-                            angle = random.random() * math.pi * 2
-                            speed = random.random() * 5
-                            self.sparks.append(
-                                Spark(
-                                    self.player.rect().center,
-                                    angle,
-                                    2 + random.random(),
-                                )
-                            )
-                            self.particles.append(
-                                Particle(
-                                    self,
-                                    "particle",
-                                    self.player.rect().center,
-                                    velocity=[
-                                        math.cos(angle + math.pi) * speed * 0.5,
-                                        math.sin(angle + math.pi) * speed * 0.5,
-                                    ],
-                                    frame=random.randint(0, 7),
-                                )
-                            )
-
-            for spark in self.sparks.copy():
-                kill = spark.update()
-                spark.render(self.display, offset=render_scroll)
-                if kill:
-                    self.sparks.remove(spark)
-
-            display_mask = pygame.mask.from_surface(self.display)
-            display_silhouette = display_mask.to_surface(
-                setcolor=(0, 0, 0, 180), unsetcolor=(0, 0, 0, 0)
-            )
 
-            for offset in ((-1, 0), (1, 0), (0, -1), (0, 1)):
-                self.display2.blit(display_silhouette, offset)
+                for offset in ((-1, 0), (1, 0), (0, -1), (0, 1)):
+                    self.display2.blit(display_silhouette, offset)
 
-            for particle in self.particles.copy():
-                kill = particle.update()
-                particle.render(self.display, offset=render_scroll)
-                if particle.p_type == "leaf":
-                    particle.pos[0] += math.sin(particle.animation.frame * 0.035) * 0.3
-                if kill:
-                    self.particles.remove(particle)
+        with profiler.phase("particles"):
+            world.particles.render(self.display, offset=render_scroll)
 
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    self.quit()
-                if event.type == pygame.KEYDOWN:
-                    if event.key == pygame.K_LEFT:
-                        self.movement[0] = True
-                    if event.key == pygame.K_RIGHT:
-                        self.movement[1] = True
-                    if event.key == pygame.K_UP:
-                        if self.player.jump():
-                            self.sfx["jump"].play()
-                    if event.key == pygame.K_x:
-                        self.player.dash()
-                    if (
-                        event.key == pygame.K_c
-                        and pygame.key.get_mods() & pygame.K_LCTRL
-                    ) or event.key == pygame.K_ESCAPE:
-                        self.quit()
-
-                if event.type == pygame.KEYUP:
-                    if event.key == pygame.K_LEFT:
-                        self.movement[0] = False
-                    if event.key == pygame.K_RIGHT:
-                        self.movement[1] = False
-
-            if self.transition:
+        if world.transition:
+            with profiler.phase("transition"):
                 transition_surf = pygame.Surface(self.display.get_size())
                 pygame.draw.circle(
                     transition_surf,
                     pygame.Color("white"),
                     (self.display.get_width() // 2, self.display.get_height() // 2),
-                    (30 - abs(self.transition)) * 8,
+                    (30 - abs(world.transition)) * 8,
                 )
                 transition_surf.set_colorkey(pygame.Color("white"))
                 self.display.blit(transition_surf, (0, 0))
 
+        with profiler.phase("scale"):
             self.display2.blit(self.display, (0, 0))
 
             screenshake_offset = (
-                random.random() * self.screenshake - self.screenshake / 2,
-                random.random() * self.screenshake - self.screenshake / 2,
+                self.rng.random() * world.screenshake - world.screenshake / 2,
+                self.rng.random() * world.screenshake - world.screenshake / 2,
             )
             self.screen.blit(
                 pygame.transform.scale(self.display2, self.screen.get_size()),
                 screenshake_offset,
             )
+
+        if self.show_profile:
+            with profiler.phase("overlay"):
+                profiler.render(self.screen)
+
+        with profiler.phase("present"):
             pygame.display.update()
-            self.clock.tick(60)
 
-    @staticmethod
-    def quit():
+    def run(self):
+        pygame.mixer.music.load(os.path.join("data", "music.wav"))
+        pygame.mixer.music.set_volume(0.5)
+        pygame.mixer.music.play(-1)
+
+        self.sfx["ambience"].play(-1)
+
+        # The simulation advances in fixed steps of 1 / STEP_RATE seconds no
+        # matter how long rendering takes, leftover time carries over
+        step_time = 1 / STEP_RATE
+        accumulator = step_time
+        last_time = time.perf_counter()
+        while True:
+            with profiler.phase("events"):
+                self.handle_events()
+
+            steps = 0
+            max_steps = MAX_STEPS_PER_FRAME * self.speed
+            with profiler.phase("simulation"):
+                while accumulator >= step_time and steps < max_steps:
+                    self.step()
+                    accumulator -= step_time
+                    steps += 1
+            if steps == max_steps:
+                accumulator = min(accumulator, step_time)
+            profiler.count("steps", steps)
+
+            self.render(accumulator / step_time if self.interpolate else 1.0)
+            with profiler.phase("wait"):
+                self.clock.tick(STEP_RATE)
+
+            profiler.end_frame()
+            if self.profile_path and profiler.frame % PROFILE_EXPORT_EVERY == 0:
+                profiler.export(self.profile_path)
+
+            now = time.perf_counter()
+            accumulator += (now - last_time) * self.speed
+            last_time = now
+
+    def quit(self):
+        if self.recording is not None:
+            self.recording.state_hash = self.world.state_hash()
+            self.recording.save(self.record_path)
+
+        self.world.close()
         pygame.quit()
         sys.exit()
 
 
+def seed(text):
+    # Seeds have to fit in the replay header
+    value = int(text)
+    if not 0 <= value < 2**64:
+        raise argparse.ArgumentTypeError(f"{text} is not between 0 and 2**64 - 1")
+
+    return value
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--profile",
+        metavar="PATH",
+        help="export frame timings to PATH (.csv or .json) every few seconds",
+    )
+    parser.add_argument(
+        "--seed", type=seed, help="seed of the simulation, from 0 to 2**64 - 1"
+    )
+    parser.add_argument(
+        "--record", metavar="PATH", help="record the inputs to a replay file on quit"
+    )
+    parser.add_argument("--replay", metavar="PATH", help="play a replay file")
+    parser.add_argument(
+        "--speed", type=int, default=1, help="replay speed, in times real time"
+    )
+    args = parser.parse_args()
+
+    game = Game(
+        profile_path=args.profile,
+        seed=args.seed,
+        record_path=args.record,
+        replay=Replay.load(args.replay) if args.replay else None,
+        speed=args.speed,
+    )
     try:
-        Game().run()
+        game.run()
     except KeyboardInterrupt:
-        pygame.quit()
-        sys.exit()
+        game.quit()
@@ -0,0 +1,119 @@
+import json
+import os
+
+import pygame
+
+ATLAS_WIDTH = 512
+# Gap between packed images, so scaled or filtered blits never bleed
+ATLAS_PADDING = 1
+CACHE_PATH = os.path.join("data", "cache")
+ATLAS_IMAGE = "atlas.png"
+ATLAS_INDEX = "atlas.json"
+
+
+def norm_path(path):
+    return os.path.normpath(path).replace(os.sep, "/")
+
+
+def source_stamps(base_path):
+    # Modification time and size of every source image, keyed by the path
+    # relative to base_path. The atlas is rebuilt whenever these change.
+    stamps = {}
+    for root, _, files in os.walk(base_path):
+        for name in files:
+            if name.endswith(".png"):
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                stamps[norm_path(os.path.relpath(path, base_path))] = [
+                    stat.st_mtime_ns,
+                    stat.st_size,
+                ]
+
+    return stamps
+
+
+def pack(sizes):
+    # Shelf packing, tallest images first. Returns the rect of every image
+    # and the height of the atlas.
+    rects = {}
+    x = y = shelf_height = 0
+    for name, (w, h) in sorted(sizes.items(), key=lambda item: -item[1][1]):
+        if x + w > ATLAS_WIDTH:
+            x = 0
+            y += shelf_height + ATLAS_PADDING
+            shelf_height = 0
+        rects[name] = [x, y, w, h]
+        x += w + ATLAS_PADDING
+        shelf_height = max(shelf_height, h)
+
+    return rects, y + shelf_height
+
+
+# Every image under base_path packed into a single surface, with an index of
+# where each one is. The packed image and index are cached in CACHE_PATH so
+# later runs decode one file instead of one per sprite frame.
+class Atlas:
+    def __init__(self, base_path, cache_path=CACHE_PATH) -> None:
+        self.base_path = base_path
+        self.image_path = os.path.join(cache_path, ATLAS_IMAGE)
+        self.index_path = os.path.join(cache_path, ATLAS_INDEX)
+
+        stamps = source_stamps(base_path)
+        if not self.load(stamps):
+            self.build(stamps)
+            self.save(stamps)
+
+        if pygame.display.get_surface():
+            self.surface = self.surface.convert()
+
+        self.dirs = {}
+        for path in self.rects:
+            head, name = path.rpartition("/")[::2]
+            self.dirs.setdefault(head, []).append(name)
+
+    def load(self, stamps):
+        try:
+            with open(self.index_path) as fin:
+                index = json.load(fin)
+            if index["stamps"] != stamps:
+                return False
+            self.surface = pygame.image.load(self.image_path)
+        except (OSError, ValueError, KeyError, pygame.error):
+            return False
+
+        self.rects = index["rects"]
+        return True
+
+    def build(self, stamps):
+        images = {
+            path: pygame.image.load(os.path.join(self.base_path, path))
+            for path in stamps
+        }
+        self.rects, height = pack(
+            {path: img.get_size() for path, img in images.items()}
+        )
+
+        self.surface = pygame.Surface((ATLAS_WIDTH, max(height, 1)), pygame.SRCALPHA)
+        self.surface.fill((0, 0, 0, 0))
+        for path, img in images.items():
+            # Copies the pixels as they are, colors of transparent pixels
+            # included, instead of blending them
+            self.surface.blit(
+                img, self.rects[path][:2], special_flags=pygame.BLEND_RGBA_MAX
+            )
+
+    def save(self, stamps):
+        # A read-only install still works, it just rebuilds on every start
+        try:
+            os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+            pygame.image.save(self.surface, self.image_path)
+            with open(self.index_path, "w") as fout:
+                json.dump({"stamps": stamps, "rects": self.rects}, fout)
+        except (OSError, pygame.error):
+            pass
+
+    def image(self, path):
+        return self.surface.subsurface(self.rects[norm_path(path)])
+
+    def listdir(self, path):
+        return list(self.dirs.get(norm_path(path), []))
@@ -0,0 +1,223 @@
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import time
+
+# Episodes run without a window or an audio device
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import numpy as np
+
+from scripts import mapfile
+from scripts.bench import input_script
+from scripts.world import (
+    INPUT_DASH,
+    INPUT_JUMP,
+    INPUT_LEFT,
+    INPUT_RIGHT,
+    MAPS_PATH,
+    STEP_RATE,
+    World,
+    level_index,
+    load_assets,
+)
+
+BATCH_SEEDS = 16
+# Steps an episode may take to clear its map, a minute of play
+BATCH_STEPS = 60 * STEP_RATE
+BATCH_PATH = os.path.join("data", "cache", "batch")
+
+
+def rush_script(frames, seed):
+    # Runs one way for a few seconds at a time, jumping every half second
+    # and dashing whenever the dash is ready
+    rng = random.Random(seed)
+    masks = []
+    held = INPUT_RIGHT
+    for i in range(frames):
+        if i % 180 == 0:
+            held = rng.choice([INPUT_LEFT, INPUT_RIGHT, INPUT_RIGHT])
+        mask = held
+        if i % 30 == 0:
+            mask |= INPUT_JUMP
+        if i % 70 == 0:
+            mask |= INPUT_DASH
+        masks.append(mask)
+
+    return masks
+
+
+def idle_script(frames, seed):
+    return [0] * frames
+
+
+# Input scripts by name, each makes the inputs of every step of an episode
+# from its seed
+SCRIPTS = {
+    "random": input_script,
+    "rush": rush_script,
+    "idle": idle_script,
+}
+
+# Assets of the worker process, loaded once by init_worker
+_assets = None
+
+
+def init_worker():
+    global _assets
+    _assets = load_assets()
+
+
+def run_episode(job):
+    # Plays one map from the start until all of its enemies are dead or
+    # steps run out
+    map_id, seed, script, steps, maps_path = job
+    with World(_assets, level=map_id, maps_path=maps_path, seed=seed) as world:
+        enemies = len(world.enemies)
+        deaths = 0
+        clear_step = None
+        for inputs in SCRIPTS[script](steps, seed):
+            dead = world.dead
+            world.step(inputs)
+            if world.dead and not dead:
+                deaths += 1
+            if not world.enemies and world.level == map_id:
+                clear_step = world.frame
+                break
+
+    return {
+        "map": map_id,
+        "script": script,
+        "seed": seed,
+        "enemies": enemies,
+        "cleared": clear_step is not None,
+        "clear_step": clear_step,
+        "deaths": deaths,
+        "kills": world.kills,
+        "steps": world.frame,
+    }
+
+
+def run(jobs, workers=None):
+    # Episodes are independent and only their small results come back, so
+    # they spread over the workers with nothing shared between them
+    workers = workers or os.cpu_count() or 1
+    chunksize = max(1, len(jobs) // (workers * 4))
+    with multiprocessing.Pool(workers, initializer=init_worker) as pool:
+        results = list(pool.imap_unordered(run_episode, jobs, chunksize))
+
+    return sorted(
+        results, key=lambda result: (result["map"], result["script"], result["seed"])
+    )
+
+
+def summarize(results):
+    # Outcomes of the episodes of every map and script
+    groups = {}
+    for result in results:
+        groups.setdefault((result["map"], result["script"]), []).append(result)
+
+    summary = []
+    for (map_id, script), episodes in sorted(groups.items()):
+        clear_times = [
+            episode["clear_step"] / STEP_RATE
+            for episode in episodes
+            if episode["cleared"]
+        ]
+        summary.append(
+            {
+                "map": map_id,
+                "script": script,
+                "episodes": len(episodes),
+                "enemies": episodes[0]["enemies"],
+                "clear_rate": round(len(clear_times) / len(episodes), 4),
+                "clear_mean_s": (
+                    round(float(np.mean(clear_times)), 2) if clear_times else None
+                ),
+                "clear_p50_s": (
+                    round(float(np.median(clear_times)), 2) if clear_times else None
+                ),
+                "deaths_mean": round(
+                    float(np.mean([episode["deaths"] for episode in episodes])), 2
+                ),
+                "kills_mean": round(
+                    float(np.mean([episode["kills"] for episode in episodes])), 2
+                ),
+            }
+        )
+
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Plays many headless episodes of every map on all cores and "
+        "reports how they went"
+    )
+    parser.add_argument("--maps", type=int, nargs="*", help="map ids, all by default")
+    parser.add_argument(
+        "--scripts",
+        nargs="*",
+        choices=sorted(SCRIPTS),
+        default=sorted(SCRIPTS),
+        help="input scripts, all by default",
+    )
+    parser.add_argument("--seeds", type=int, default=BATCH_SEEDS)
+    parser.add_argument("--first-seed", type=int, default=0)
+    parser.add_argument("--steps", type=int, default=BATCH_STEPS)
+    parser.add_argument(
+        "--workers", type=int, help="processes, one per core by default"
+    )
+    parser.add_argument("--maps-path", default=MAPS_PATH)
+    parser.add_argument(
+        "--output", help="results file, data/cache/batch/results.json by default"
+    )
+    args = parser.parse_args()
+
+    map_ids = args.maps if args.maps else level_index(args.maps_path)
+    # Built here once, so the workers don't all race to build the caches
+    load_assets()
+    for map_id in map_ids:
+        mapfile.compiled(os.path.join(args.maps_path, f"{map_id}.json"))
+
+    jobs = [
+        (map_id, seed, script, args.steps, args.maps_path)
+        for map_id in map_ids
+        for script in args.scripts
+        for seed in range(args.first_seed, args.first_seed + args.seeds)
+    ]
+    start = time.perf_counter()
+    results = run(jobs, args.workers)
+    elapsed = time.perf_counter() - start
+
+    summary = summarize(results)
+    for group in summary:
+        clear_time = (
+            f"{group['clear_mean_s']:6.1f} s"
+            if group["clear_mean_s"] is not None
+            else "     - "
+        )
+        print(
+            f"map {group['map']:<3} {group['script']:<8}"
+            f" cleared {group['clear_rate']:>6.1%} in {clear_time}"
+            f"  deaths {group['deaths_mean']:5.2f}"
+            f"  kills {group['kills_mean']:5.2f} of {group['enemies']} enemies"
+        )
+    steps = sum(result["steps"] for result in results)
+    print(
+        f"{len(results)} episodes, {steps} steps in {elapsed:.1f} s"
+        f" ({steps / elapsed:.0f} steps/s)"
+    )
+
+    output = args.output or os.path.join(BATCH_PATH, "results.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as fout:
+        json.dump({"summary": summary, "episodes": results}, fout, indent=2)
+    print(f"wrote {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,324 @@
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import subprocess
+import time
+import tracemalloc
+
+# Benchmarks run without a window or an audio device
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import numpy as np
+import pygame
+
+from game import Game
+from scripts.entities import Enemy
+from scripts.tilemap import Tilemap
+from scripts.world import (
+    INPUT_DASH,
+    INPUT_JUMP,
+    INPUT_LEFT,
+    INPUT_RIGHT,
+    MAPS_PATH,
+    level_index,
+)
+
+BENCH_PATH = os.path.join("data", "cache", "bench")
+BENCH_FRAMES = 600
+# Frames run before measuring, while chunk surfaces and outlines get cached
+BENCH_WARMUP = 60
+# Frames run after the timed ones with tracemalloc on, which slows them down
+# too much to time them
+BENCH_TRACED = 120
+BENCH_SEED = 0
+
+STRESS_PARTICLES = 3000
+STRESS_ENEMIES = 300
+# Size of the synthetic map in tiles
+LARGE_MAP_SIZE = (1024, 96)
+
+
+def input_script(frames, seed=BENCH_SEED):
+    # The same inputs for a seed on every run: a direction held for 20
+    # frames at a time, sometimes with a jump or a dash at its start
+    rng = random.Random(seed)
+    masks = []
+    for i in range(frames):
+        if i % 20 == 0:
+            held = rng.choice([0, INPUT_LEFT, INPUT_RIGHT])
+            masks.append(held | rng.choice([0, 0, INPUT_JUMP, INPUT_DASH]))
+        else:
+            masks.append(held)
+
+    return masks
+
+
+def ground_spots(tilemap):
+    # Pixel positions standing on top of a solid tile
+    return sorted(
+        (x * tilemap.tile_size + 4, (y - 1) * tilemap.tile_size)
+        for x, y, _, _ in tilemap.grid.items()
+        if tilemap.is_solid(x, y) and not tilemap.is_solid(x, y - 1)
+    )
+
+
+def add_enemies(world, rng, count):
+    spots = ground_spots(world.tilemap)
+    for _ in range(count):
+        enemy = Enemy(world, rng.choice(spots), (8, 15))
+        world.enemies.append(enemy)
+        world.collisions.add(enemy, "enemies")
+
+
+def large_map(path, size=LARGE_MAP_SIZE, seed=BENCH_SEED):
+    # Rolling hills of grass over stone, with enemy spawners on top
+    rng = random.Random(seed)
+    tilemap = Tilemap(None, tile_size=16)
+    spawners = []
+    width, height = size
+    ground = height // 2
+    for x in range(width):
+        ground = min(height - 8, max(8, ground + rng.choice([-1, 0, 0, 1])))
+        tilemap.fill_rect((x, ground), (x, ground + 2), "grass", 0)
+        tilemap.fill_rect((x, ground + 3), (x, height - 1), "stone", 0)
+        if x == 4 or x % 16 == 0:
+            spawners.append(
+                {
+                    "type": "spawners",
+                    "variant": 0 if x == 4 else 1,
+                    "pos": [x * tilemap.tile_size, (ground - 1) * tilemap.tile_size],
+                }
+            )
+    tilemap.autotile()
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as fout:
+        json.dump(
+            {
+                "tilemap": {
+                    f"{tile['pos'][0]};{tile['pos'][1]}": tile
+                    for tile in tilemap.tiles()
+                },
+                "tile_size": tilemap.tile_size,
+                "offgrid": spawners,
+            },
+            fout,
+            separators=(",", ":"),
+        )
+
+
+class Scenario:
+    def __init__(
+        self, name, map_id=0, maps_path=MAPS_PATH, particles=0, enemies=0, build=None
+    ):
+        self.name = name
+        self.map_id = map_id
+        self.maps_path = maps_path
+        self.particles = particles
+        self.enemies = enemies
+        # Makes the maps of the scenario, called only when it is run
+        self.build = build
+
+    def setup(self, game, rng):
+        # Called before every frame, outside of the measured time. Tops the
+        # stress load up again after it died out or the level was reloaded.
+        world = game.world
+        if self.enemies and len(world.enemies) < self.enemies:
+            add_enemies(world, rng, self.enemies - len(world.enemies))
+
+        if self.particles:
+            width, height = game.display.get_size()
+            for _ in range(self.particles - len(world.particles)):
+                world.particles.spawn(
+                    "leaf",
+                    (
+                        game.scroll[0] + rng.random() * width,
+                        game.scroll[1] + rng.random() * height,
+                    ),
+                    velocity=[-0.1, 0.2],
+                    frame=rng.randint(0, 20),
+                )
+
+
+def scenarios():
+    found = [Scenario(f"map{map_id}", map_id) for map_id in level_index()]
+
+    large_path = os.path.join(BENCH_PATH, "large")
+    found += [
+        Scenario("particles", particles=STRESS_PARTICLES),
+        Scenario("enemies", enemies=STRESS_ENEMIES),
+        Scenario(
+            "large_map",
+            maps_path=large_path,
+            build=lambda: large_map(os.path.join(large_path, "0.json")),
+        ),
+    ]
+
+    return found
+
+
+def run(
+    scenario,
+    frames=BENCH_FRAMES,
+    warmup=BENCH_WARMUP,
+    traced=BENCH_TRACED,
+    seed=BENCH_SEED,
+):
+    if scenario.build:
+        scenario.build()
+
+    rng = random.Random(seed)
+    # Without the rewind history, which would otherwise be most of what a
+    # frame allocates and keeps
+    game = Game(
+        audio=False,
+        level=scenario.map_id,
+        maps_path=scenario.maps_path,
+        seed=seed,
+        rewind=False,
+    )
+    inputs = input_script(warmup + frames + traced, seed)
+
+    frame_times = []
+    step_times = []
+    peaks = []
+    retained = []
+    collections = 0
+    for i, mask in enumerate(inputs):
+        scenario.setup(game, rng)
+        game.movement = [bool(mask & INPUT_LEFT), bool(mask & INPUT_RIGHT)]
+        game.pressed = mask & (INPUT_JUMP | INPUT_DASH)
+        pygame.event.pump()
+
+        tracing = i >= warmup + frames
+        if tracing:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            start_memory = tracemalloc.get_traced_memory()[0]
+        start_collections = gc.get_stats()[0]["collections"]
+        start = time.perf_counter()
+        game.step()
+        stepped = time.perf_counter()
+        game.render()
+        end = time.perf_counter()
+
+        if tracing:
+            memory, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - start_memory)
+            retained.append(memory - start_memory)
+        elif i >= warmup:
+            frame_times.append(end - start)
+            step_times.append(stepped - start)
+            collections += gc.get_stats()[0]["collections"] - start_collections
+    tracemalloc.stop()
+
+    frame_ms = np.array(frame_times) * 1000
+    result = {
+        "name": scenario.name,
+        "frames": frames,
+        "fps": round(frames / frame_ms.sum() * 1000, 1),
+        "mean_ms": round(float(frame_ms.mean()), 4),
+        "p50_ms": round(float(np.percentile(frame_ms, 50)), 4),
+        "p95_ms": round(float(np.percentile(frame_ms, 95)), 4),
+        "p99_ms": round(float(np.percentile(frame_ms, 99)), 4),
+        "max_ms": round(float(frame_ms.max()), 4),
+        "step_ms": round(float(np.mean(step_times)) * 1000, 4),
+        # Collections of the youngest generation, each one after about 700
+        # more container objects were allocated than freed
+        "gc_per_frame": round(collections / frames, 4),
+        # From the traced frames: the most memory a frame had allocated on
+        # top of what it started with, and how much of it was still there
+        # once the frame was over
+        "alloc_peak_kb": round(float(np.mean(peaks)) / 1024, 2) if peaks else None,
+        "retained_kb": round(float(np.mean(retained)) / 1024, 3) if retained else None,
+        "enemies": len(game.world.enemies),
+        "particles": len(game.world.particles),
+    }
+    game.world.close()
+    return result
+
+
+def commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Plays every map and stress scenario with the same inputs "
+        "and reports frame times"
+    )
+    parser.add_argument("names", nargs="*", help="scenarios to run, all by default")
+    parser.add_argument("--frames", type=int, default=BENCH_FRAMES)
+    parser.add_argument(
+        "--traced",
+        type=int,
+        default=BENCH_TRACED,
+        help="frames traced for allocations after the timed ones",
+    )
+    parser.add_argument("--seed", type=int, default=BENCH_SEED)
+    parser.add_argument(
+        "--output", help="results file, data/cache/bench/<commit>.json by default"
+    )
+    parser.add_argument("--baseline", help="results file to compare against")
+    args = parser.parse_args()
+
+    revision = commit()
+    results = []
+    for scenario in scenarios():
+        if args.names and scenario.name not in args.names:
+            continue
+        result = run(scenario, args.frames, traced=args.traced, seed=args.seed)
+        results.append(result)
+        print(
+            f"{result['name']:<12} {result['fps']:>9.1f} fps"
+            f"  p50 {result['p50_ms']:.2f}  p95 {result['p95_ms']:.2f}"
+            f"  p99 {result['p99_ms']:.2f} ms"
+            + (
+                f"  {result['alloc_peak_kb']:.1f} KB allocated/frame"
+                if result["alloc_peak_kb"] is not None
+                else ""
+            )
+        )
+
+    report = {
+        "commit": revision,
+        "seed": args.seed,
+        "python": platform.python_version(),
+        "pygame": pygame.version.ver,
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "results": results,
+    }
+    output = args.output or os.path.join(BENCH_PATH, f"{revision or 'results'}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as fout:
+        json.dump(report, fout, indent=2)
+    print(f"wrote {output}")
+
+    if args.baseline:
+        with open(args.baseline) as fin:
+            baseline = {result["name"]: result for result in json.load(fin)["results"]}
+        for result in results:
+            old = baseline.get(result["name"])
+            if old:
+                print(
+                    f"{result['name']:<12} mean {result['mean_ms'] / old['mean_ms'] - 1:+.1%}"
+                    f"  p99 {result['p99_ms'] / old['p99_ms'] - 1:+.1%}"
+                )
+
+
+if __name__ == "__main__":
+    main()
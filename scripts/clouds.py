@@ -2,6 +2,8 @@ import random
 
 import pygame
 
+from scripts.profiler import profiler
+
 
 class Cloud:
     def __init__(self, pos, img, speed, depth) -> None:
@@ -31,16 +33,18 @@ class Cloud:
 
 
 class Clouds:
-    def __init__(self, cloud_images, count=16) -> None:
+    def __init__(self, cloud_images, count=16, rng=None) -> None:
+        if rng is None:
+            rng = random.Random()
         self.clouds = []
 
         for i in range(count):
             self.clouds.append(
                 Cloud(
-                    (random.random() * 99999, random.random() * 99999),
-                    random.choice(cloud_images),
-                    random.random() * 0.05 + 0.05,
-                    random.random() * 0.6 + 0.2,
+                    (rng.random() * 99999, rng.random() * 99999),
+                    rng.choice(cloud_images),
+                    rng.random() * 0.05 + 0.05,
+                    rng.random() * 0.6 + 0.2,
                 )
             )
 
@@ -51,5 +55,6 @@ class Clouds:
             c.update()
 
     def render(self, surf, offset=(0, 0)):
+        profiler.count("blits", len(self.clouds))
         for c in self.clouds:
             c.render(surf, offset)
@@ -0,0 +1,83 @@
+from scripts.spatial import SpatialHash
+
+
+# Broad phase for collisions between entities. Registered entities are kept
+# in a SpatialHash by their rects, each in a group such as "enemies" or
+# "projectiles", so finding what overlaps a rect, or which entities of two
+# groups touch each other, only looks at the cells involved instead of at
+# every entity or every pair. Results come in registration order.
+class CollisionManager:
+    def __init__(self, cell_size=32) -> None:
+        self.hash = SpatialHash(cell_size)
+        self.keys = {}
+        # group -> {key: entity}
+        self.groups = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, entity):
+        return entity in self.keys
+
+    def clear(self):
+        self.hash.clear()
+        self.keys = {}
+        self.groups = {}
+
+    def add(self, entity, group, rect=None):
+        # rect is taken from the entity unless given
+        key = self.hash.insert(entity, entity.rect() if rect is None else rect)
+        self.keys[entity] = key
+        self.groups.setdefault(group, {})[key] = entity
+
+    def add_points(self, items, points, group):
+        # Adds each of items as the 1x1 rect at its integer point
+        members = self.groups.setdefault(group, {})
+        for key, item in zip(self.hash.insert_points(items, points), items):
+            self.keys[item] = key
+            members[key] = item
+
+    def remove(self, entity):
+        key = self.keys.pop(entity)
+        self.hash.remove(key)
+        for members in self.groups.values():
+            members.pop(key, None)
+
+    def clear_group(self, group):
+        members = self.groups.pop(group, {})
+        for entity in members.values():
+            del self.keys[entity]
+        self.hash.remove_many(members)
+
+    def move(self, entity):
+        # Called after the entity moved
+        self.hash.move(self.keys[entity], entity.rect())
+
+    def query(self, rect):
+        entries = self.hash.entries
+        return [entries[key][0] for key in self.hash.query(rect)]
+
+    def candidate_pairs(self, first, second):
+        # Keys of the entities of first and second sharing a cell, each pair
+        # once. Only the cells of first are looked at, so first should be the
+        # smaller group.
+        seconds = self.groups.get(second, {})
+        cells = self.hash.cells
+        entries = self.hash.entries
+        pairs = set()
+        for a in self.groups.get(first, {}):
+            for cell in entries[a][2]:
+                for b in cells[cell]:
+                    if b in seconds and b != a:
+                        pairs.add((a, b))
+
+        return sorted(pairs)
+
+    def pairs(self, first, second):
+        # Pairs of an entity of first and one of second whose rects overlap
+        entries = self.hash.entries
+        return [
+            (entries[a][0], entries[b][0])
+            for a, b in self.candidate_pairs(first, second)
+            if entries[a][1].colliderect(entries[b][1])
+        ]
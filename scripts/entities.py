@@ -1,11 +1,9 @@
 import math
-import random
 
 import pygame
 from pygame.math import Vector2
 
-from scripts.particles import Particle
-from scripts.sparks import Spark
+from scripts.utils import draw, flip_x
 
 MAX_FALL_VEOLICITY = 5
 
@@ -15,6 +13,8 @@ class PhysicsEntity:
         self.game = game
         self.e_type = e_type
         self.pos = list(pos)
+        # Position before the last update, to interpolate between steps
+        self.prev_pos = list(pos)
         self.size = size
         self.velocity = [0, 0]
         self.collision = {"up": False, "down": False, "right": False, "left": False}
@@ -29,17 +29,70 @@ class PhysicsEntity:
     def rect(self):
         return pygame.Rect(self.pos[0], self.pos[1], self.size[0], self.size[1])
 
+    def state(self):
+        # What an update carries over to the next one, see World.state_hash
+        return (
+            self.e_type,
+            self.pos,
+            self.velocity,
+            self.collision,
+            self.flip,
+            self.action,
+            self.animation.frame,
+            self.last_movement,
+        )
+
+    def snapshot(self):
+        # Everything state() holds, for restore, see World.snapshot. Only
+        # what is changed in place is copied, the rest is replaced by
+        # update rather than changed, so it can be shared.
+        return (
+            self.pos.copy(),
+            self.prev_pos,
+            self.velocity.copy(),
+            self.collision,
+            self.flip,
+            self.action,
+            self.animation,
+            self.animation.frame,
+            self.animation.done,
+            self.last_movement,
+        )
+
+    def restore(self, state):
+        (
+            pos,
+            self.prev_pos,
+            velocity,
+            self.collision,
+            self.flip,
+            self.action,
+            self.animation,
+            self.animation.frame,
+            self.animation.done,
+            self.last_movement,
+        ) = state
+        self.pos = pos.copy()
+        self.velocity = velocity.copy()
+
     def set_action(self, action):
         if action != self.action:
             self.action = action
             self.animation = self.game.assets[f"{self.e_type}/{self.action}"].copy()
 
     def update(self, tilemap, movement=None):
-        self.collision = {"up": False, "down": False, "right": False, "left": False}
-
         if movement is None:
             movement = (0, 0)
 
+        self.move(tilemap, movement)
+        self.end_update(movement)
+
+    def move(self, tilemap, movement):
+        # Tile collisions, scripts.physics.move_entities does the same for
+        # many entities at once
+        self.collision = {"up": False, "down": False, "right": False, "left": False}
+        self.prev_pos = self.pos.copy()
+
         fm_x = movement[0] + self.velocity[0]
         fm_y = movement[1] + self.velocity[1]
         self.pos[0] += fm_x
@@ -68,6 +121,7 @@ class PhysicsEntity:
 
                 self.pos[1] = entity_rect.y
 
+    def end_update(self, movement):
         # This is not an if else as i don't want flip
         # the animation if the character is still
         if movement[0] > 0:
@@ -84,11 +138,21 @@ class PhysicsEntity:
 
         self.animation.update()
 
-    def render(self, surf, offset=(0, 0)):
+    def render_offset(self, offset, alpha=1.0):
+        # Camera offset that draws the entity at its position interpolated
+        # between the last two simulation steps
+        return (
+            offset[0] + (self.pos[0] - self.prev_pos[0]) * (1 - alpha),
+            offset[1] + (self.pos[1] - self.prev_pos[1]) * (1 - alpha),
+        )
+
+    def render(self, surf, offset=(0, 0), outline_only=False):
         # surf.blit(self.game.assets["player"], Vector2(self.pos) - Vector2(offset))
-        surf.blit(
-            pygame.transform.flip(self.animation.img(), self.flip, False),
+        draw(
+            surf,
+            self.animation.img(self.flip),
             Vector2(self.pos) - Vector2(offset) + Vector2(self.anim_offset),
+            outline_only,
         )
 
 
@@ -100,6 +164,26 @@ class Player(PhysicsEntity):
         self.wall_slide = False
         self.dashing = 0
 
+    def state(self):
+        return super().state() + (
+            self.air_time,
+            self.jumps,
+            self.wall_slide,
+            self.dashing,
+        )
+
+    def snapshot(self):
+        return super().snapshot() + (
+            self.air_time,
+            self.jumps,
+            self.wall_slide,
+            self.dashing,
+        )
+
+    def restore(self, state):
+        super().restore(state[:-4])
+        self.air_time, self.jumps, self.wall_slide, self.dashing = state[-4:]
+
     def update(self, tilemap, movement=(0, 0)):
         super().update(tilemap, movement)
 
@@ -132,17 +216,14 @@ class Player(PhysicsEntity):
 
         if abs(self.dashing) in {60, 50}:
             for i in range(20):
-                angle = random.random() * math.pi * 2
-                speed = random.random() * 0.5 + 0.5
+                angle = self.game.rng.random() * math.pi * 2
+                speed = self.game.rng.random() * 0.5 + 0.5
                 pvelocity = [math.cos(angle) * speed, math.sin(angle) * speed]
-                self.game.particles.append(
-                    Particle(
-                        self.game,
-                        "particle",
-                        self.rect().center,
-                        pvelocity,
-                        random.randint(0, 7),
-                    )
+                self.game.particles.spawn(
+                    "particle",
+                    self.rect().center,
+                    pvelocity,
+                    self.game.rng.randint(0, 7),
                 )
 
         if self.dashing > 0:
@@ -160,15 +241,15 @@ class Player(PhysicsEntity):
             if abs(self.dashing) == 51:
                 self.velocity[0] *= 0.1
 
-            pvelocity = [abs(self.dashing) / self.dashing * random.random() * 3, 0]
-            self.game.particles.append(
-                Particle(
-                    self.game,
-                    "particle",
-                    self.rect().center,
-                    pvelocity,
-                    random.randint(0, 7),
-                )
+            pvelocity = [
+                abs(self.dashing) / self.dashing * self.game.rng.random() * 3,
+                0,
+            ]
+            self.game.particles.spawn(
+                "particle",
+                self.rect().center,
+                pvelocity,
+                self.game.rng.randint(0, 7),
             )
 
     def jump(self):
@@ -200,12 +281,12 @@ class Player(PhysicsEntity):
                 self.game.sfx["dash"].play()
                 self.dashing = 60
 
-    def render(self, surf, offset=None):
+    def render(self, surf, offset=None, outline_only=False):
         if offset is None:
             offset = (0, 0)
 
         if abs(self.dashing) <= 50:
-            super().render(surf, offset)
+            super().render(surf, offset, outline_only)
 
 
 class Enemy(PhysicsEntity):
@@ -213,7 +294,21 @@ class Enemy(PhysicsEntity):
         super().__init__(game, "enemy", pos, size)
         self.walking = 0
 
+    def state(self):
+        return super().state() + (self.walking,)
+
+    def snapshot(self):
+        return super().snapshot() + (self.walking,)
+
+    def restore(self, state):
+        super().restore(state[:-1])
+        self.walking = state[-1]
+
     def update(self, tilemap, movement=None):
+        super().update(tilemap, self.think(tilemap, movement))
+
+    def think(self, tilemap, movement=None):
+        # Everything before moving, returns the movement to make
         if movement is None:
             movement = (0, 0)
 
@@ -236,99 +331,49 @@ class Enemy(PhysicsEntity):
                 )
                 if abs(dis[1]) < tilemap.tile_size:
                     if self.flip and dis[0] < 0:
-                        projectile = [
-                            [self.rect().centerx - 7, self.rect().centery],
-                            -1.5,
-                            0,
-                        ]
-                        self.game.sfx["shoot"].play()
-                        self.game.projectiles.append(projectile)
-                        for _ in range(4):
-                            self.game.sparks.append(
-                                Spark(
-                                    projectile[0],
-                                    random.random() - 0.5 + math.pi,
-                                    2 + random.random(),
+                        pos = [self.rect().centerx - 7, self.rect().centery]
+                        if self.game.projectiles.spawn(pos, -1.5):
+                            self.game.sfx["shoot"].play()
+                            for _ in range(4):
+                                self.game.sparks.spawn(
+                                    pos,
+                                    self.game.rng.random() - 0.5 + math.pi,
+                                    2 + self.game.rng.random(),
                                 )
-                            )
                     if not self.flip and dis[0] > 0:
-                        projectile = [
-                            [self.rect().centerx + 7, self.rect().centery],
-                            1.5,
-                            0,
-                        ]
-                        self.game.sfx["shoot"].play()
-                        self.game.projectiles.append(projectile)
-                        for _ in range(4):
-                            self.game.sparks.append(
-                                Spark(
-                                    projectile[0],
-                                    random.random() - 0.5,
-                                    2 + random.random(),
+                        pos = [self.rect().centerx + 7, self.rect().centery]
+                        if self.game.projectiles.spawn(pos, 1.5):
+                            self.game.sfx["shoot"].play()
+                            for _ in range(4):
+                                self.game.sparks.spawn(
+                                    pos,
+                                    self.game.rng.random() - 0.5,
+                                    2 + self.game.rng.random(),
                                 )
-                            )
 
-        elif random.random() < 0.01:
-            self.walking = random.randint(30, 120)  # number of frames walking
+        elif self.game.rng.random() < 0.01:
+            self.walking = self.game.rng.randint(30, 120)  # number of frames walking
 
-        super().update(tilemap, movement)
+        return movement
+
+    def end_update(self, movement):
+        super().end_update(movement)
 
         if movement[0] != 0:
             self.set_action("run")
         else:
             self.set_action("idle")
 
-        if abs(self.game.player.dashing) >= 50:
-            if self.rect().colliderect(self.game.player.rect()):
-                self.game.screenshake = max(16, self.game.screenshake)
-                self.game.sfx["hit"].play()
-                for _ in range(30):
-                    angle = random.random() * math.pi * 2
-                    speed = random.random() * 5
-                    self.game.sparks.append(
-                        Spark(
-                            self.rect().center,
-                            angle,
-                            2 + random.random(),
-                        )
-                    )
-                    self.game.particles.append(
-                        Particle(
-                            self.game,
-                            "particle",
-                            self.rect().center,
-                            velocity=[
-                                math.cos(angle + math.pi) * speed * 0.5,
-                                math.sin(angle + math.pi) * speed * 0.5,
-                            ],
-                            frame=random.randint(0, 7),
-                        )
-                    )
-                self.game.sparks.append(
-                    Spark(
-                        self.rect().center,
-                        0,
-                        5 + random.random(),
-                    )
-                )
-                self.game.sparks.append(
-                    Spark(
-                        self.rect().center,
-                        math.pi,
-                        5 + random.random(),
-                    )
-                )
-                return True
-
-    def render(self, surf: pygame.Surface, offset=None):
+    def render(self, surf: pygame.Surface, offset=None, outline_only=False):
         if offset is None:
             offset = (0, 0)
 
-        super().render(surf, offset)
+        super().render(surf, offset, outline_only)
 
         if self.flip:
-            surf.blit(
-                pygame.transform.flip(self.game.assets["gun"], True, False),
+            draw(
+                surf,
+                flip_x(self.game.assets["gun"]),
                 (
                     self.rect().centerx
                     - 4
@@ -336,12 +381,15 @@ class Enemy(PhysicsEntity):
                     - offset[0],
                     self.rect().centery - offset[1],
                 ),
+                outline_only,
             )
         else:
-            surf.blit(
+            draw(
+                surf,
                 self.game.assets["gun"],
                 (
                     self.rect().centerx + 4 - offset[0],
                     self.rect().centery - offset[1],
                 ),
+                outline_only,
             )
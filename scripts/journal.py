@@ -0,0 +1,232 @@
+import array
+import collections
+import json
+import os
+
+from scripts.tilegrid import EMPTY
+
+JOURNAL_EXT = ".journal"
+# Undo history kept in memory, whichever limit is reached first
+JOURNAL_STROKES = 256
+JOURNAL_CELLS = 500000
+
+
+# The changes made by one stroke, in the order they happened. Cell changes
+# are packed six ints each, (x, y, old type id, old variant, new type id,
+# new variant), and off-grid changes are (added, tile).
+class Stroke:
+    __slots__ = ("cells", "offgrid")
+
+    def __init__(self, cells, offgrid) -> None:
+        self.cells = cells
+        self.offgrid = offgrid
+
+    def __len__(self):
+        return len(self.cells) // 6
+
+
+# Records the edits made to a tilemap, grouped in strokes, for undo and redo.
+# Every finished stroke, undo and redo is also appended to a journal file as
+# the cells and off-grid tiles it changed, so the map is autosaved without
+# writing all of it. recover replays that file over the saved map, and
+# truncate empties it once the whole map has been saved again.
+class EditJournal:
+    def __init__(self, tilemap, path, limit=JOURNAL_STROKES, cell_limit=JOURNAL_CELLS):
+        self.tilemap = tilemap
+        self.path = path
+        self.limit = limit
+        self.cell_limit = cell_limit
+
+        self.undo_stack = collections.deque()
+        self.redo_stack = []
+        self.cell_count = 0
+        # Changes since the last end, packed like Stroke.cells
+        self.cells = array.array("i")
+        self.offgrid = []
+        # Current off-grid key of every tile that was added or removed, undo
+        # and redo add tiles back under new keys
+        self.offgrid_keys = {}
+        # Set while applying undo, redo or the journal file, which must not
+        # be recorded as new edits
+        self.applying = False
+
+        tilemap.journal = self
+
+    def cell_changed(self, x, y, old, new):
+        if not self.applying:
+            self.cells.extend((x, y, old[0], old[1], new[0], new[1]))
+
+    def cells_changed(self, changes):
+        # Takes a flat list of changes, six ints each like Stroke.cells
+        if not self.applying:
+            self.cells.extend(changes)
+
+    def offgrid_added(self, key, tile):
+        self.offgrid_keys[id(tile)] = key
+        if not self.applying:
+            self.offgrid.append((True, tile))
+
+    def offgrid_removed(self, key, tile):
+        self.offgrid_keys.pop(id(tile), None)
+        if not self.applying:
+            self.offgrid.append((False, tile))
+
+    def end(self):
+        # Closes the current stroke, if anything changed since the last end
+        cells = self.cells
+        offgrid = self.offgrid
+        self.cells = array.array("i")
+        self.offgrid = []
+        if not cells and not offgrid:
+            return
+
+        stroke = Stroke(cells, offgrid)
+        self.clear_redo()
+        self.push_undo(stroke)
+        self.append(stroke, undo=False)
+
+    def push_undo(self, stroke):
+        self.undo_stack.append(stroke)
+        self.cell_count += len(stroke)
+        while self.undo_stack and (
+            len(self.undo_stack) > self.limit or self.cell_count > self.cell_limit
+        ):
+            self.cell_count -= len(self.undo_stack.popleft())
+
+    def clear_redo(self):
+        for stroke in self.redo_stack:
+            self.cell_count -= len(stroke)
+        self.redo_stack = []
+
+    def undo(self):
+        self.end()
+        if not self.undo_stack:
+            return False
+
+        stroke = self.undo_stack.pop()
+        self.apply(stroke, undo=True)
+        self.redo_stack.append(stroke)
+        self.append(stroke, undo=True)
+        return True
+
+    def redo(self):
+        self.end()
+        if not self.redo_stack:
+            return False
+
+        stroke = self.redo_stack.pop()
+        self.apply(stroke, undo=False)
+        self.undo_stack.append(stroke)
+        self.append(stroke, undo=False)
+        return True
+
+    def apply(self, stroke, undo):
+        tilemap = self.tilemap
+        cells = stroke.cells
+        # Values are written as they were, without autotiling them again
+        value = 2 if undo else 4
+        self.applying = True
+        try:
+            starts = range(0, len(cells), 6)
+            for i in reversed(starts) if undo else starts:
+                x = cells[i]
+                y = cells[i + 1]
+                tilemap.write_cell(x, y, cells[i + value], cells[i + value + 1])
+                tilemap.variant_changed((x, y))
+
+            offgrid = reversed(stroke.offgrid) if undo else stroke.offgrid
+            for added, tile in offgrid:
+                if added != undo:
+                    tilemap.add_offgrid(tile)
+                else:
+                    tilemap.remove_offgrid(self.offgrid_keys[id(tile)])
+        finally:
+            self.applying = False
+
+    def append(self, stroke, undo):
+        # Entries hold the type names and the cells as a flat list of x, y,
+        # type id, variant, the values to write in order
+        cells = stroke.cells
+        value = 2 if undo else 4
+        starts = range(0, len(cells), 6)
+        offgrid = reversed(stroke.offgrid) if undo else stroke.offgrid
+        entry = {
+            "types": self.tilemap.grid.type_names,
+            "cells": [
+                cell_value
+                for i in (reversed(starts) if undo else starts)
+                for cell_value in (
+                    cells[i],
+                    cells[i + 1],
+                    cells[i + value],
+                    cells[i + value + 1],
+                )
+            ],
+            "offgrid": [
+                ["add" if added != undo else "remove", tile] for added, tile in offgrid
+            ],
+        }
+        # The journal is a convenience, the editor keeps working without it
+        try:
+            with open(self.path, "a") as fout:
+                fout.write(json.dumps(entry, separators=(",", ":")) + "\n")
+        except OSError:
+            pass
+
+    def recover(self):
+        # Replays the journal file over the map, returns the number of entries
+        try:
+            fin = open(self.path)
+        except FileNotFoundError:
+            return 0
+
+        tilemap = self.tilemap
+        count = 0
+        self.applying = True
+        try:
+            with fin:
+                for line in fin:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Cut short by a crash while it was written
+                        break
+
+                    type_ids = [EMPTY] + [
+                        tilemap.grid.type_id(name) for name in entry["types"][1:]
+                    ]
+                    cells = entry["cells"]
+                    for i in range(0, len(cells), 4):
+                        x = cells[i]
+                        y = cells[i + 1]
+                        tilemap.write_cell(x, y, type_ids[cells[i + 2]], cells[i + 3])
+                        tilemap.variant_changed((x, y))
+                    for action, tile in entry["offgrid"]:
+                        if action == "add":
+                            tilemap.add_offgrid(tile)
+                        else:
+                            key = self.find_offgrid(tile)
+                            if key is not None:
+                                tilemap.remove_offgrid(key)
+                    count += 1
+        finally:
+            self.applying = False
+
+        return count
+
+    def find_offgrid(self, tile):
+        for key, other in self.tilemap.offgrid.items():
+            if (
+                other["type"] == tile["type"]
+                and other["variant"] == tile["variant"]
+                and list(other["pos"]) == list(tile["pos"])
+            ):
+                return key
+
+    def truncate(self):
+        # Called after the whole map was saved, the journal is part of it now
+        try:
+            if os.path.exists(self.path):
+                open(self.path, "w").close()
+        except OSError:
+            pass
@@ -0,0 +1,290 @@
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+
+from scripts.tilegrid import CHUNK_AREA, CHUNK_SIZE, TileGrid
+
+MAP_EXT = ".map"
+MAGIC = b"PMAP"
+VERSION = 1
+# Compiled copies of JSON maps, see compiled()
+CACHE_PATH = os.path.join("data", "cache", "maps")
+
+# The file is laid out as:
+#   header
+#   type names, a length byte then the UTF-8 name, in type id order from 1
+#   chunk index, the location of every chunk and the offset of its cells
+#   off-grid table
+#   spawner table, indices into the off-grid table
+#   chunk cells, CHUNK_AREA type ids then CHUNK_AREA variants per chunk
+# Type id 0 is the empty cell, like in TileGrid.
+
+# magic, version, tile size, chunk size, and the number of types, chunks,
+# off-grid tiles and spawners
+HEADER = struct.Struct("<4sHHHHIII")
+# chunk x, chunk y, offset of the chunk cells from the start of the file
+CHUNK_ENTRY = struct.Struct("<iiI")
+# type id, variant, x, y
+OFFGRID_ENTRY = struct.Struct("<HHdd")
+SPAWNER_ENTRY = struct.Struct("<I")
+
+SPAWNER_TYPE = "spawners"
+
+
+# Read-only view of a binary map. The file is memory-mapped and only the
+# header and chunk index are parsed up front, chunk cells and off-grid tiles
+# are read from the mapping when asked for.
+class MapFile:
+    def __init__(self, path) -> None:
+        self.path = path
+        with open(path, "rb") as fin:
+            self.data = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            (
+                magic,
+                version,
+                self.tile_size,
+                chunk_size,
+                type_count,
+                chunk_count,
+                self.offgrid_count,
+                spawner_count,
+            ) = HEADER.unpack_from(self.data)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError(f"{path} is not a version {VERSION} map file")
+            if chunk_size != CHUNK_SIZE:
+                raise ValueError(f"{path} has {chunk_size} tile chunks")
+
+            offset = HEADER.size
+            self.type_names = [None]
+            for _ in range(type_count):
+                length = self.data[offset]
+                self.type_names.append(
+                    self.data[offset + 1 : offset + 1 + length].decode()
+                )
+                offset += 1 + length
+
+            self.chunk_offsets = {}
+            for cx, cy, chunk_offset in CHUNK_ENTRY.iter_unpack(
+                self.data[offset : offset + CHUNK_ENTRY.size * chunk_count]
+            ):
+                self.chunk_offsets[(cx, cy)] = chunk_offset
+            offset += CHUNK_ENTRY.size * chunk_count
+
+            self.offgrid_offset = offset
+            offset += OFFGRID_ENTRY.size * self.offgrid_count
+            self.spawner_indices = [
+                i
+                for (i,) in SPAWNER_ENTRY.iter_unpack(
+                    self.data[offset : offset + SPAWNER_ENTRY.size * spawner_count]
+                )
+            ]
+        except (struct.error, IndexError, UnicodeDecodeError):
+            self.close()
+            raise ValueError(f"{path} is not a valid map file")
+        except ValueError:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.data.close()
+
+    def type_table(self, grid: TileGrid):
+        # Table for bytes.translate from the type ids of this file to the ids
+        # of grid, registering the types grid doesn't know yet
+        table = bytearray(range(256))
+        for file_id, name in enumerate(self.type_names[1:], start=1):
+            table[file_id] = grid.type_id(name)
+        return bytes(table)
+
+    def read_chunk(self, chunk_loc):
+        # Type ids and variants of the cells of a chunk, or None if the chunk
+        # is empty
+        offset = self.chunk_offsets.get(chunk_loc)
+        if offset is None:
+            return None
+
+        return (
+            self.data[offset : offset + CHUNK_AREA],
+            self.data[offset + CHUNK_AREA : offset + 2 * CHUNK_AREA],
+        )
+
+    def offgrid_tile(self, i):
+        type_id, variant, x, y = OFFGRID_ENTRY.unpack_from(
+            self.data, self.offgrid_offset + OFFGRID_ENTRY.size * i
+        )
+        return {"type": self.type_names[type_id], "variant": variant, "pos": [x, y]}
+
+    def offgrid_tiles(self):
+        return [self.offgrid_tile(i) for i in range(self.offgrid_count)]
+
+    def spawners(self):
+        return [self.offgrid_tile(i) for i in self.spawner_indices]
+
+    def tiles(self):
+        for chunk_loc in self.chunk_offsets:
+            types, variants = self.read_chunk(chunk_loc)
+            base_x = chunk_loc[0] * CHUNK_SIZE
+            base_y = chunk_loc[1] * CHUNK_SIZE
+            for i in range(CHUNK_AREA):
+                if types[i]:
+                    yield {
+                        "type": self.type_names[types[i]],
+                        "variant": variants[i],
+                        "pos": [base_x + i % CHUNK_SIZE, base_y + i // CHUNK_SIZE],
+                    }
+
+
+def write(path, tile_size, grid: TileGrid, offgrid):
+    type_ids = {}
+    for name in grid.type_names[1:]:
+        type_ids[name] = len(type_ids) + 1
+    for tile in offgrid:
+        if tile["type"] not in type_ids:
+            type_ids[tile["type"]] = len(type_ids) + 1
+
+    # The grid cells are stored with the grid's own type ids, which the type
+    # names above keep in the same order
+    names = b"".join(bytes((len(name.encode()),)) + name.encode() for name in type_ids)
+    spawners = [i for i, tile in enumerate(offgrid) if tile["type"] == SPAWNER_TYPE]
+    chunk_locs = sorted(grid.chunks)
+
+    data_offset = (
+        HEADER.size
+        + len(names)
+        + CHUNK_ENTRY.size * len(chunk_locs)
+        + OFFGRID_ENTRY.size * len(offgrid)
+        + SPAWNER_ENTRY.size * len(spawners)
+    )
+    parts = [
+        HEADER.pack(
+            MAGIC,
+            VERSION,
+            tile_size,
+            CHUNK_SIZE,
+            len(type_ids),
+            len(chunk_locs),
+            len(offgrid),
+            len(spawners),
+        ),
+        names,
+    ]
+    for i, chunk_loc in enumerate(chunk_locs):
+        parts.append(
+            CHUNK_ENTRY.pack(
+                chunk_loc[0], chunk_loc[1], data_offset + 2 * CHUNK_AREA * i
+            )
+        )
+    for tile in offgrid:
+        parts.append(
+            OFFGRID_ENTRY.pack(type_ids[tile["type"]], tile["variant"], *tile["pos"])
+        )
+    for i in spawners:
+        parts.append(SPAWNER_ENTRY.pack(i))
+    for chunk_loc in chunk_locs:
+        parts.append(grid.chunks[chunk_loc].types)
+        parts.append(grid.chunks[chunk_loc].variants)
+
+    # Written next to the destination and moved over it, so a running game
+    # never maps a half-written file. The temporary name is unique, so
+    # processes writing the same map at once don't write into each other's.
+    with tempfile.NamedTemporaryFile(
+        dir=os.path.dirname(path) or ".",
+        prefix=os.path.basename(path) + ".",
+        suffix=".tmp",
+        delete=False,
+    ) as fout:
+        tmp_path = fout.name
+        try:
+            fout.writelines(parts)
+        except BaseException:
+            fout.close()
+            os.remove(tmp_path)
+            raise
+    os.replace(tmp_path, path)
+
+
+def from_json(map_data):
+    grid = TileGrid()
+    for tile in map_data["tilemap"].values():
+        grid.set(
+            tile["pos"][0],
+            tile["pos"][1],
+            grid.type_id(tile["type"]),
+            tile["variant"],
+        )
+
+    return grid
+
+
+def to_json(map_file: MapFile):
+    return {
+        "tilemap": {
+            f"{tile['pos'][0]};{tile['pos'][1]}": tile for tile in map_file.tiles()
+        },
+        "tile_size": map_file.tile_size,
+        "offgrid": map_file.offgrid_tiles(),
+    }
+
+
+def convert(src, dst):
+    # Converts a JSON map to a binary one or back, based on the extension of src
+    if src.endswith(MAP_EXT):
+        with MapFile(src) as map_file:
+            map_data = to_json(map_file)
+        with open(dst, "w") as fout:
+            json.dump(map_data, fout, separators=(",", ":"))
+    else:
+        with open(src) as fin:
+            map_data = json.load(fin)
+        write(dst, map_data["tile_size"], from_json(map_data), map_data["offgrid"])
+
+
+def is_current(path):
+    # Whether path is a map file in this version of the format
+    try:
+        with open(path, "rb") as fin:
+            magic, version = HEADER.unpack(fin.read(HEADER.size))[:2]
+    except (OSError, struct.error):
+        return False
+
+    return magic == MAGIC and version == VERSION
+
+
+def compiled(path, cache_path=CACHE_PATH):
+    # Binary copy of the JSON map at path, converted again whenever the JSON
+    # is newer or the copy was written in another version of the format.
+    # Falls back to path itself if the cache can't be written.
+    if path.endswith(MAP_EXT):
+        return path
+
+    name = os.path.splitext(os.path.normpath(path))[0].replace(os.sep, "_")
+    map_path = os.path.join(cache_path, name + MAP_EXT)
+    try:
+        if (
+            not os.path.exists(map_path)
+            or os.stat(map_path).st_mtime_ns < os.stat(path).st_mtime_ns
+            or not is_current(map_path)
+        ):
+            os.makedirs(cache_path, exist_ok=True)
+            convert(path, map_path)
+    except OSError:
+        return path
+
+    return map_path
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        sys.exit("usage: python -m scripts.mapfile SRC DST")
+    convert(sys.argv[1], sys.argv[2])
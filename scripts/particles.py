@@ -1,37 +1,138 @@
-class Particle:
-    def __init__(self, game, p_type, pos, velocity=None, frame=0) -> None:
-        if velocity is None:
-            velocity = [0, 0]
+import numpy as np
+
+from scripts.profiler import profiler
+
+# Horizontal sine sway applied to particle types, as the amplitude in pixels
+SINE_DRIFT = {"leaf": 0.3}
 
+
+# Every live particle is a row in a set of NumPy arrays, kept packed at the
+# front so update and expiry are a few vectorized operations regardless of
+# how many particles there are. Animations are taken from the
+# "particle/<type>" assets and never copied.
+class ParticleSystem:
+    def __init__(self, game, capacity=256) -> None:
         self.game = game
-        self.p_type = p_type
-        self.pos = list(pos)
-        self.velocity = list(velocity)
-        self.animation = self.game.assets[f"particle/{p_type}"].copy()
-        self.animation.frame = frame
+        self.count = 0
+
+        self.type_ids = {}
+        self.images = []
+        self.img_durations = np.zeros(0, dtype=np.int32)
+        self.last_frames = np.zeros(0, dtype=np.int32)
+        self.loops = np.zeros(0, dtype=bool)
+        self.drifts = np.zeros(0)
+
+        self.pos = np.zeros((capacity, 2))
+        self.velocity = np.zeros((capacity, 2))
+        self.frame = np.zeros(capacity, dtype=np.int32)
+        self.type = np.zeros(capacity, dtype=np.int32)
+        self.done = np.zeros(capacity, dtype=bool)
+
+    def __len__(self):
+        return self.count
+
+    def type_id(self, p_type):
+        if p_type not in self.type_ids:
+            animation = self.game.assets[f"particle/{p_type}"]
+            self.type_ids[p_type] = len(self.images)
+            self.images.append(animation.images)
+            self.img_durations = np.append(self.img_durations, animation.img_duration)
+            self.last_frames = np.append(
+                self.last_frames, animation.img_duration * len(animation.images) - 1
+            )
+            self.loops = np.append(self.loops, animation.loop)
+            self.drifts = np.append(self.drifts, SINE_DRIFT.get(p_type, 0))
+
+        return self.type_ids[p_type]
+
+    def grow(self):
+        capacity = len(self.frame) * 2
+        for name in ("pos", "velocity", "frame", "type", "done"):
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[: self.count] = old[: self.count]
+            setattr(self, name, new)
+
+    def spawn(self, p_type, pos, velocity=None, frame=0):
+        if velocity is None:
+            velocity = (0, 0)
+
+        if self.count == len(self.frame):
+            self.grow()
+
+        i = self.count
+        self.pos[i] = pos
+        self.velocity[i] = velocity
+        self.frame[i] = frame
+        self.type[i] = self.type_id(p_type)
+        self.done[i] = False
+        self.count += 1
+
+    def snapshot(self):
+        # Copies of the live rows, see World.snapshot
+        n = self.count
+        return n, [
+            getattr(self, name)[:n].copy()
+            for name in ("pos", "velocity", "frame", "type", "done")
+        ]
+
+    def restore(self, state):
+        n, arrays = state
+        while n > len(self.frame):
+            self.grow()
+        for name, arr in zip(("pos", "velocity", "frame", "type", "done"), arrays):
+            getattr(self, name)[:n] = arr
+        self.count = n
+
+    def clear(self):
+        self.count = 0
 
     def update(self):
-        kill = False
+        n = self.count
+        if not n:
+            return
+
+        # Particles whose animation finished on the previous update expire now
+        kill = self.done[:n].copy()
 
-        if self.animation.done:
-            kill = True
+        types = self.type[:n]
+        frame = self.frame[:n]
+        self.pos[:n] += self.velocity[:n]
 
-        self.pos[0] += self.velocity[0]
-        self.pos[1] += self.velocity[1]
+        last_frames = self.last_frames[types]
+        loops = self.loops[types]
+        frame += 1
+        np.copyto(frame, frame % (last_frames + 1), where=loops)
+        np.minimum(frame, last_frames, out=frame)
+        self.done[:n] = ~loops & (frame >= last_frames)
 
-        self.animation.update()
+        drifts = self.drifts[types]
+        self.pos[:n, 0] += np.sin(frame * 0.035) * drifts
 
-        return kill
+        if kill.any():
+            keep = ~kill
+            m = int(keep.sum())
+            for arr in (self.pos, self.velocity, self.frame, self.type, self.done):
+                arr[:m] = arr[:n][keep]
+            self.count = m
 
     def render(self, surf, offset=None):
         if offset is None:
             offset = (0, 0)
 
-        img = self.animation.img()
-        surf.blit(
-            img,
-            (
-                self.pos[0] - offset[0] - img.get_width() // 2,
-                self.pos[1] - offset[1] - img.get_height() // 2,
-            ),
-        )
+        n = self.count
+        if not n:
+            return
+
+        images = self.images
+        types = self.type[:n].tolist()
+        indices = (self.frame[:n] // self.img_durations[self.type[:n]]).tolist()
+        xs = (self.pos[:n, 0] - offset[0]).tolist()
+        ys = (self.pos[:n, 1] - offset[1]).tolist()
+
+        blits = []
+        for t, i, x, y in zip(types, indices, xs, ys):
+            img = images[t][i]
+            blits.append((img, (x - img.get_width() // 2, y - img.get_height() // 2)))
+        surf.blits(blits, doreturn=False)
+        profiler.count("blits", n)
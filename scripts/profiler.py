@@ -0,0 +1,181 @@
+import collections
+import csv
+import json
+import os
+import tempfile
+import time
+
+import pygame
+
+# Frames kept for the overlay averages and the exports
+PROFILE_HISTORY = 300
+# Seconds between refreshes of the overlay text
+OVERLAY_REFRESH = 0.25
+
+
+class Phase:
+    __slots__ = ("times", "name", "start")
+
+    def __init__(self, times, name) -> None:
+        self.times = times
+        self.name = name
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.times[self.name] += time.perf_counter() - self.start
+
+
+# Times the phases of every frame and counts what was drawn in it. Phases
+# with the same name add up within a frame. The last history frames are
+# kept, for the overlay drawn by render and for export, which writes them
+# to a .csv or .json file, replacing what was exported before.
+class FrameProfiler:
+    def __init__(self, history=PROFILE_HISTORY) -> None:
+        self.frames = collections.deque(maxlen=history)
+        self.times = collections.defaultdict(float)
+        self.counts = collections.Counter()
+        self.phases = {}
+        self.frame = 0
+        self.frame_start = time.perf_counter()
+
+        self.font = None
+        self.overlay = None
+        self.overlay_time = 0
+
+    def phase(self, name):
+        phase = self.phases.get(name)
+        if phase is None:
+            phase = self.phases[name] = Phase(self.times, name)
+
+        return phase
+
+    def count(self, name, n=1):
+        self.counts[name] += n
+
+    def end_frame(self):
+        now = time.perf_counter()
+        times = dict(self.times)
+        times["frame"] = now - self.frame_start
+        self.frames.append((self.frame, times, dict(self.counts)))
+        self.frame += 1
+        self.frame_start = now
+        self.times.clear()
+        self.counts.clear()
+
+    def columns(self):
+        # Phase and counter names seen in the kept frames, in first-seen order
+        phases = {"frame": None}
+        counts = {}
+        for _, times, frame_counts in self.frames:
+            phases.update(dict.fromkeys(times))
+            counts.update(dict.fromkeys(frame_counts))
+
+        return list(phases), list(counts)
+
+    def averages(self):
+        # Mean milliseconds per phase and mean counts over the kept frames
+        phases, counts = self.columns()
+        n = len(self.frames) or 1
+        return (
+            {
+                name: sum(times.get(name, 0) for _, times, _ in self.frames) * 1000 / n
+                for name in phases
+            },
+            {
+                name: sum(
+                    frame_counts.get(name, 0) for _, _, frame_counts in self.frames
+                )
+                / n
+                for name in counts
+            },
+        )
+
+    def rows(self):
+        phases, counts = self.columns()
+        return [
+            {
+                "frame": frame,
+                **{
+                    f"{name}_ms": round(times.get(name, 0) * 1000, 4) for name in phases
+                },
+                **{name: frame_counts.get(name, 0) for name in counts},
+            }
+            for frame, times, frame_counts in self.frames
+        ]
+
+    def export(self, path):
+        # Written next to path first, so readers never see half a file. The
+        # temporary name is unique, so games exporting to the same path at
+        # once don't write into each other's.
+        rows = self.rows()
+        with tempfile.NamedTemporaryFile(
+            "w",
+            newline="",
+            dir=os.path.dirname(path) or ".",
+            prefix=os.path.basename(path) + ".",
+            suffix=".tmp",
+            delete=False,
+        ) as fout:
+            tmp_path = fout.name
+            try:
+                if path.endswith(".json"):
+                    json.dump(rows, fout)
+                else:
+                    writer = csv.DictWriter(
+                        fout, fieldnames=list(rows[0]) if rows else []
+                    )
+                    writer.writeheader()
+                    writer.writerows(rows)
+            except BaseException:
+                fout.close()
+                os.remove(tmp_path)
+                raise
+        os.replace(tmp_path, path)
+
+    def render(self, surf, pos=(4, 4)):
+        # The text is only rebuilt a few times per second, so it stays
+        # readable and costs little
+        now = time.perf_counter()
+        if self.overlay is None or now - self.overlay_time >= OVERLAY_REFRESH:
+            self.overlay_time = now
+            self.overlay = self.render_text()
+
+        surf.blit(self.overlay, pos)
+
+    def drop_font(self):
+        self.font = None
+        self.overlay = None
+
+    def render_text(self):
+        if self.font is None:
+            self.font = pygame.font.Font(None, 18)
+            # The font can't be used once pygame quits, a Game made after
+            # that needs a new one
+            pygame.register_quit(self.drop_font)
+
+        phase_ms, counts = self.averages()
+        frame_ms = phase_ms.pop("frame")
+        lines = [f"{1000 / frame_ms if frame_ms else 0:.0f} fps  {frame_ms:.2f} ms"]
+        lines += [f"{name}  {ms:.2f} ms" for name, ms in phase_ms.items()]
+        lines += [f"{name}  {n:.0f}" for name, n in counts.items()]
+
+        images = [self.font.render(line, True, (255, 255, 255)) for line in lines]
+        line_height = self.font.get_linesize()
+        overlay = pygame.Surface(
+            (
+                max(img.get_width() for img in images) + 8,
+                line_height * len(images) + 8,
+            ),
+            pygame.SRCALPHA,
+        )
+        overlay.fill((0, 0, 0, 160))
+        for i, img in enumerate(images):
+            overlay.blit(img, (4, 4 + i * line_height))
+
+        return overlay
+
+
+profiler = FrameProfiler()
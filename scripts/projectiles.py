@@ -0,0 +1,107 @@
+import numpy as np
+
+from scripts.profiler import profiler
+from scripts.utils import outline
+
+# Frames a projectile flies before it disappears
+PROJECTILE_LIFETIME = 360
+
+
+# Fixed-size pool of projectiles stored as NumPy arrays, packed at the front.
+# Movement and wall hits are resolved for all of them at once, hits on
+# entities go through the CollisionManager, see register.
+class ProjectileSystem:
+    def __init__(self, game, capacity=512) -> None:
+        self.game = game
+        self.count = 0
+        self.pos = np.zeros((capacity, 2))
+        self.direction = np.zeros(capacity)
+        self.timer = np.zeros(capacity, dtype=np.int32)
+
+    def __len__(self):
+        return self.count
+
+    def spawn(self, pos, direction):
+        # Returns False when the pool is full and the shot is dropped
+        if self.count == len(self.timer):
+            return False
+
+        i = self.count
+        self.pos[i] = pos
+        self.direction[i] = direction
+        self.timer[i] = 0
+        self.count += 1
+        return True
+
+    def snapshot(self):
+        # Copies of the live rows, see World.snapshot
+        n = self.count
+        return n, [
+            getattr(self, name)[:n].copy() for name in ("pos", "direction", "timer")
+        ]
+
+    def restore(self, state):
+        n, arrays = state
+        for name, arr in zip(("pos", "direction", "timer"), arrays):
+            getattr(self, name)[:n] = arr
+        self.count = n
+
+    def clear(self):
+        self.count = 0
+
+    def update(self, tilemap):
+        # Moves every projectile and removes the ones that are done. Returns
+        # the (pos, direction) of projectiles that hit a wall.
+        n = self.count
+        if not n:
+            return []
+
+        pos = self.pos[:n]
+        pos[:, 0] += self.direction[:n]
+        self.timer[:n] += 1
+
+        wall = tilemap.solid_check_many(pos)
+        wall_hits = list(zip(pos[wall].tolist(), self.direction[:n][wall].tolist()))
+        self.keep(~(wall | (self.timer[:n] > PROJECTILE_LIFETIME)))
+
+        return wall_hits
+
+    def register(self, collisions):
+        # Puts every projectile in the "projectiles" group of collisions, as
+        # its index, by the pixel it is on. Rect.collidepoint truncates the
+        # point to integers the same way.
+        collisions.clear_group("projectiles")
+        points = self.pos[: self.count].astype(np.int64).tolist()
+        collisions.add_points(range(self.count), points, "projectiles")
+
+    def remove(self, indices):
+        keep = np.ones(self.count, dtype=bool)
+        keep[list(indices)] = False
+        self.keep(keep)
+
+    def keep(self, keep):
+        # Packs the projectiles where keep is True at the front
+        if keep.all():
+            return
+
+        n = self.count
+        m = int(keep.sum())
+        for arr in (self.pos, self.direction, self.timer):
+            arr[:m] = arr[:n][keep]
+        self.count = m
+
+    def render(self, surf, offset=(0, 0), outline_only=False):
+        n = self.count
+        if not n:
+            return
+
+        img = self.game.assets["projectile"]
+        xs = (self.pos[:n, 0] - img.get_width() / 2 - offset[0]).tolist()
+        ys = (self.pos[:n, 1] - img.get_height() / 2 - offset[1]).tolist()
+        if outline_only:
+            shadow = outline(img)
+            blits = [(shadow, (x - 1, y - 1)) for x, y in zip(xs, ys)]
+        else:
+            blits = [(img, pos) for pos in zip(xs, ys)]
+        surf.blits(blits, doreturn=False)
+        profiler.count("blits", n)
@@ -0,0 +1,121 @@
+import os
+import struct
+import sys
+import tempfile
+import time
+import zlib
+
+from scripts.world import World
+
+REPLAY_EXT = ".replay"
+MAGIC = b"PRPL"
+VERSION = 1
+
+# The file is a header followed by the zlib-compressed input masks, one byte
+# per step. The seed and the inputs are all it takes to play a run again.
+
+# magic, version, seed, starting level, number of steps, and the
+# World.state_hash after the last step
+HEADER = struct.Struct("<4sHQiI32s")
+
+
+class Replay:
+    def __init__(self, seed, level=0, inputs=b"", state_hash=None) -> None:
+        # Checked here rather than in save, so a recording never runs to
+        # the end only to be lost
+        if not 0 <= seed < 2**64:
+            raise ValueError(f"seed {seed} doesn't fit in a replay, use 0 to 2**64 - 1")
+        self.seed = seed
+        self.level = level
+        self.inputs = bytearray(inputs)
+        self.state_hash = state_hash
+
+    def __len__(self):
+        return len(self.inputs)
+
+    def record(self, inputs):
+        self.inputs.append(inputs)
+
+    def save(self, path):
+        data = HEADER.pack(
+            MAGIC,
+            VERSION,
+            self.seed,
+            self.level,
+            len(self.inputs),
+            bytes.fromhex(self.state_hash) if self.state_hash else bytes(32),
+        ) + zlib.compress(bytes(self.inputs), 9)
+
+        # Written next to path first, so a crash never leaves half a file.
+        # The temporary name is unique, so recorders saving the same replay
+        # at once don't write into each other's.
+        with tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(path) or ".",
+            prefix=os.path.basename(path) + ".",
+            suffix=".tmp",
+            delete=False,
+        ) as fout:
+            tmp_path = fout.name
+            try:
+                fout.write(data)
+            except BaseException:
+                fout.close()
+                os.remove(tmp_path)
+                raise
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as fin:
+            data = fin.read()
+
+        magic, version, seed, level, steps, state_hash = HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a replay")
+        if version != VERSION:
+            raise ValueError(f"{path} has unsupported version {version}")
+
+        inputs = zlib.decompress(data[HEADER.size :])
+        if len(inputs) != steps:
+            raise ValueError(f"{path} is truncated")
+
+        return cls(seed, level, inputs, state_hash.hex() if any(state_hash) else None)
+
+
+def play(replay, **kwargs):
+    # Runs the replay on a new World as fast as possible and returns it.
+    # kwargs go to World.
+    world = World(seed=replay.seed, level=replay.level, **kwargs)
+    step = world.step
+    for inputs in replay.inputs:
+        step(inputs)
+
+    return world
+
+
+def verify(replay, **kwargs):
+    # Whether playing the replay ends in the state it was recorded with
+    with play(replay, **kwargs) as world:
+        return world.state_hash() == replay.state_hash
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(f"usage: python -m scripts.replay REPLAY{REPLAY_EXT}...")
+        sys.exit(2)
+
+    failed = False
+    for path in sys.argv[1:]:
+        replay = Replay.load(path)
+        start = time.perf_counter()
+        world = play(replay)
+        elapsed = time.perf_counter() - start
+        ok = world.state_hash() == replay.state_hash
+        failed |= not ok
+        print(
+            f"{path}: {'ok' if ok else 'MISMATCH'}, {len(replay)} steps"
+            f" at {len(replay) / max(elapsed, 1e-9):.0f} steps/s"
+        )
+        world.close()
+
+    sys.exit(1 if failed else 0)
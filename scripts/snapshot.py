@@ -0,0 +1,133 @@
+import array
+import collections
+import sys
+
+# Snapshots kept for rewinding, and the memory they may take, whichever
+# limit is reached first
+SNAPSHOT_CAPACITY = 600
+SNAPSHOT_BUDGET = 32 * 1024 * 1024
+
+
+# The state of a World at one step, taken by World.snapshot and put back by
+# World.restore. Nothing in the Level being played changes while it is
+# played, so it is shared with the world instead of copied, and loading
+# another level replaces it rather than changing it. Entities keep their
+# objects, with their values copied, and particles, sparks and projectiles
+# copy their live rows. The RNG state is packed into an array, a tenth of the
+# size of the tuple random.getstate returns.
+class Snapshot:
+    __slots__ = (
+        "frame",
+        "level",
+        "dead",
+        "transition",
+        "screenshake",
+        "kills",
+        "rng_state",
+        "stage",
+        "player",
+        "enemies",
+        "particles",
+        "sparks",
+        "projectiles",
+    )
+
+    def __init__(self, world) -> None:
+        self.frame = world.frame
+        self.level = world.level
+        self.dead = world.dead
+        self.transition = world.transition
+        self.screenshake = world.screenshake
+        self.kills = world.kills
+        version, internal_state, gauss_next = world.rng.getstate()
+        self.rng_state = (version, array.array("I", internal_state), gauss_next)
+
+        self.stage = world.stage
+        self.player = world.player.snapshot()
+        self.enemies = [(enemy, enemy.snapshot()) for enemy in world.enemies]
+        self.particles = world.particles.snapshot()
+        self.sparks = world.sparks.snapshot()
+        self.projectiles = world.projectiles.snapshot()
+
+    def rng_getstate(self):
+        version, internal_state, gauss_next = self.rng_state
+        return version, tuple(internal_state), gauss_next
+
+    def nbytes(self):
+        # Memory the snapshot keeps alive. Every enemy state is laid out the
+        # same, so one is measured for all of them.
+        size = (
+            sys.getsizeof(self)
+            + sys.getsizeof(self.enemies)
+            + sys.getsizeof(self.rng_state[1])
+            + sum(
+                sys.getsizeof(arr)
+                for _, arrays in (self.particles, self.sparks, self.projectiles)
+                for arr in arrays
+            )
+            + state_nbytes(self.player)
+        )
+        if self.enemies:
+            pair = self.enemies[0]
+            size += len(self.enemies) * (sys.getsizeof(pair) + state_nbytes(pair[1]))
+
+        return size
+
+
+def value_nbytes(value):
+    # Small ints are shared by the whole interpreter
+    if isinstance(value, int) and -5 <= value <= 256:
+        return 0
+
+    return sys.getsizeof(value)
+
+
+def state_nbytes(state):
+    # Size of an entity snapshot and of the values in it. The entity moves
+    # on to new lists and dicts rather than changing the ones it had, so
+    # those count as well, only the animation and strings are shared.
+    size = sys.getsizeof(state)
+    for value in state:
+        if isinstance(value, (list, tuple)):
+            size += sys.getsizeof(value) + sum(map(value_nbytes, value))
+        elif isinstance(value, dict):
+            size += sys.getsizeof(value)
+        elif isinstance(value, (int, float)):
+            size += value_nbytes(value)
+
+    return size
+
+
+# The last snapshots taken, for rewinding. The oldest ones are dropped once
+# there are capacity of them or they take more than budget bytes, as
+# estimated by Snapshot.nbytes.
+class SnapshotRing:
+    def __init__(self, capacity=SNAPSHOT_CAPACITY, budget=SNAPSHOT_BUDGET) -> None:
+        self.capacity = capacity
+        self.budget = budget
+        self.snapshots = collections.deque()
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self.snapshots)
+
+    def clear(self):
+        self.snapshots.clear()
+        self.nbytes = 0
+
+    def push(self, snapshot):
+        self.snapshots.append((snapshot, snapshot.nbytes()))
+        self.nbytes += self.snapshots[-1][1]
+        while len(self.snapshots) > self.capacity or (
+            self.nbytes > self.budget and len(self.snapshots) > 1
+        ):
+            self.nbytes -= self.snapshots.popleft()[1]
+
+    def pop(self):
+        # The newest snapshot, None when there are none left
+        if not self.snapshots:
+            return None
+
+        snapshot, nbytes = self.snapshots.pop()
+        self.nbytes -= nbytes
+        return snapshot
@@ -1,53 +1,101 @@
 import math
 
+import numpy as np
 import pygame
 
+from scripts.utils import OUTLINE_COLOR
 
-class Spark:
-    def __init__(self, pos, angle, speed) -> None:
-        self.pos = list(pos)
-        self.angle = angle
-        self.speed = speed
+
+# Sparks stored as rows of NumPy arrays, packed at the front like
+# ParticleSystem. The direction of a spark never changes, so its cos/sin are
+# computed once on spawn and every polygon is built in one vectorized pass.
+class SparkSystem:
+    def __init__(self, capacity=128) -> None:
+        self.count = 0
+        self.pos = np.zeros((capacity, 2))
+        self.direction = np.zeros((capacity, 2))
+        self.speed = np.zeros(capacity)
+
+    def __len__(self):
+        return self.count
+
+    def grow(self):
+        capacity = len(self.speed) * 2
+        for name in ("pos", "direction", "speed"):
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[: self.count] = old[: self.count]
+            setattr(self, name, new)
+
+    def spawn(self, pos, angle, speed):
+        if self.count == len(self.speed):
+            self.grow()
+
+        i = self.count
+        self.pos[i] = pos
+        self.direction[i] = (math.cos(angle), math.sin(angle))
+        self.speed[i] = speed
+        self.count += 1
+
+    def snapshot(self):
+        # Copies of the live rows, see World.snapshot
+        n = self.count
+        return n, [
+            getattr(self, name)[:n].copy() for name in ("pos", "direction", "speed")
+        ]
+
+    def restore(self, state):
+        n, arrays = state
+        while n > len(self.speed):
+            self.grow()
+        for name, arr in zip(("pos", "direction", "speed"), arrays):
+            getattr(self, name)[:n] = arr
+        self.count = n
+
+    def clear(self):
+        self.count = 0
 
     def update(self):
-        self.pos[0] += math.cos(self.angle) * self.speed
-        self.pos[1] += math.sin(self.angle) * self.speed
+        n = self.count
+        if not n:
+            return
 
-        self.speed = max(0, self.speed - 0.1)
+        speed = self.speed[:n]
+        self.pos[:n] += self.direction[:n] * speed[:, None]
+        np.maximum(speed - 0.1, 0, out=speed)
 
-        return not self.speed
+        # Stopped sparks free their slot for the next spawn
+        keep = speed > 0
+        if not keep.all():
+            m = int(keep.sum())
+            for arr in (self.pos, self.direction, self.speed):
+                arr[:m] = arr[:n][keep]
+            self.count = m
 
-    def render(self, surf: pygame.Surface, offset=None):
+    def render(self, surf: pygame.Surface, offset=None, outline_only=False):
         if offset is None:
             offset = (0, 0)
-        render_points = [
-            (
-                self.pos[0] + math.cos(self.angle) * self.speed * 3 - offset[0],
-                self.pos[1] + math.sin(self.angle) * self.speed * 3 - offset[1],
-            ),
-            (
-                self.pos[0]
-                + math.cos(self.angle + math.pi / 2) * self.speed * 0.5
-                - offset[0],
-                self.pos[1]
-                + math.sin(self.angle + math.pi / 2) * self.speed * 0.5
-                - offset[1],
-            ),
-            (
-                self.pos[0]
-                + math.cos(self.angle + math.pi) * self.speed * 3
-                - offset[0],
-                self.pos[1]
-                + math.sin(self.angle + math.pi) * self.speed * 3
-                - offset[1],
-            ),
-            (
-                self.pos[0]
-                + math.cos(self.angle - math.pi / 2) * self.speed * 0.5
-                - offset[0],
-                self.pos[1]
-                + math.sin(self.angle - math.pi / 2) * self.speed * 0.5
-                - offset[1],
-            ),
-        ]
-        pygame.draw.polygon(surf, pygame.Color("white"), render_points)
+
+        n = self.count
+        if not n:
+            return
+
+        center = self.pos[:n] - offset
+        speed = self.speed[:n, None]
+        along = self.direction[:n] * speed * 3
+        # Direction rotated by 90 degrees
+        across = self.direction[:n, ::-1] * (-1, 1) * speed * 0.5
+
+        points = np.stack(
+            (center + along, center + across, center - along, center - across),
+            axis=1,
+        )
+        if outline_only:
+            # Drawn without blending, so surf should be a transparent layer
+            for shift in ((-1, 0), (1, 0), (0, -1), (0, 1)):
+                for render_points in (points + shift).tolist():
+                    pygame.draw.polygon(surf, OUTLINE_COLOR, render_points)
+        else:
+            color = pygame.Color("white")
+            for render_points in points.tolist():
+                pygame.draw.polygon(surf, color, render_points)
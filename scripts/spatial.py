@@ -0,0 +1,127 @@
+import itertools
+
+import pygame
+
+
+# Uniform grid of buckets, every item is registered in each cell its rect
+# overlaps. Items are kept in insertion order, so results can be drawn in the
+# same order they were added.
+class SpatialHash:
+    def __init__(self, cell_size=64) -> None:
+        self.cell_size = cell_size
+        self.cells = {}
+        # key -> [item, rect, cells]
+        self.entries = {}
+        self.next_key = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        for entry in self.entries.values():
+            yield entry[0]
+
+    def clear(self):
+        self.cells = {}
+        self.entries = {}
+
+    def cells_for(self, rect):
+        size = self.cell_size
+        return [
+            (cx, cy)
+            for cx in range(rect.left // size, (rect.right - 1) // size + 1)
+            for cy in range(rect.top // size, (rect.bottom - 1) // size + 1)
+        ]
+
+    def insert(self, item, rect):
+        key = self.next_key
+        self.next_key += 1
+
+        rect = pygame.Rect(rect)
+        cells = self.cells_for(rect)
+        for cell in cells:
+            self.cells.setdefault(cell, {})[key] = item
+        self.entries[key] = [item, rect, cells]
+
+        return key
+
+    def insert_points(self, items, points):
+        # Inserts each item as the 1x1 rect at its integer point, which is in
+        # a single cell. Returns the keys.
+        size = self.cell_size
+        cells = self.cells
+        entries = self.entries
+        start = self.next_key
+        for key, item, (x, y) in zip(itertools.count(start), items, points):
+            cell = (x // size, y // size)
+            bucket = cells.get(cell)
+            if bucket is None:
+                bucket = cells[cell] = {}
+            bucket[key] = item
+            entries[key] = [item, pygame.Rect(x, y, 1, 1), [cell]]
+        self.next_key = start + len(items)
+
+        return range(start, self.next_key)
+
+    def remove(self, key):
+        item, _, cells = self.entries.pop(key)
+        for cell in cells:
+            bucket = self.cells[cell]
+            del bucket[key]
+            if not bucket:
+                del self.cells[cell]
+
+        return item
+
+    def remove_many(self, keys):
+        cells = self.cells
+        entries = self.entries
+        for key in keys:
+            for cell in entries.pop(key)[2]:
+                bucket = cells[cell]
+                del bucket[key]
+                if not bucket:
+                    del cells[cell]
+
+    def move(self, key, rect):
+        entry = self.entries[key]
+        entry[1].update(rect)
+        cells = self.cells_for(entry[1])
+        if cells != entry[2]:
+            for cell in entry[2]:
+                bucket = self.cells[cell]
+                del bucket[key]
+                if not bucket:
+                    del self.cells[cell]
+            for cell in cells:
+                self.cells.setdefault(cell, {})[key] = entry[0]
+            entry[2] = cells
+
+    def get(self, key):
+        return self.entries[key][0]
+
+    def rect(self, key):
+        return self.entries[key][1]
+
+    def items(self):
+        return [(key, entry[0]) for key, entry in self.entries.items()]
+
+    def query(self, rect):
+        rect = pygame.Rect(rect)
+        keys = set()
+        for cell in self.cells_for(rect):
+            bucket = self.cells.get(cell)
+            if bucket:
+                keys.update(bucket)
+
+        entries = self.entries
+        return [key for key in sorted(keys) if entries[key][1].colliderect(rect)]
+
+    def query_point(self, pos):
+        size = self.cell_size
+        bucket = self.cells.get((int(pos[0] // size), int(pos[1] // size)))
+        if not bucket:
+            return []
+
+        entries = self.entries
+        return [key for key in bucket if entries[key][1].collidepoint(pos)]
@@ -0,0 +1,126 @@
+import collections
+import queue
+import threading
+
+from scripts.mapfile import MapFile
+from scripts.tilegrid import TileGrid
+
+# Chunks kept in memory while streaming, besides the ones changed by edits
+STREAM_CAPACITY = 64
+
+
+# Loads the chunks of a TileGrid from a binary map as they come into view and
+# drops the least recently seen ones once there are more than capacity. The
+# file is read on a background thread, loaded chunks are handed over to the
+# grid on the main thread in update. TileGrid.load reads a chunk that isn't
+# there yet right away, so physics never falls through one.
+class ChunkStream:
+    def __init__(self, map_file: MapFile, grid: TileGrid, capacity=STREAM_CAPACITY):
+        self.map_file = map_file
+        self.grid = grid
+        self.capacity = capacity
+        self.type_table = map_file.type_table(grid)
+
+        grid.stream = self
+        # Chunks emptied by edits, which must not be read from the file again
+        self.removed = set()
+        # Chunks read from the file, from least to most recently in view. The
+        # ones created or changed by edits are taken out, so they are never
+        # evicted and the changes aren't lost.
+        self.recent = collections.OrderedDict()
+        self.pending = set()
+
+        self.requests = queue.SimpleQueue()
+        self.results = queue.SimpleQueue()
+        self.worker = threading.Thread(target=self.work, daemon=True)
+        self.worker.start()
+
+    def on_disk(self, chunk_loc):
+        return (
+            chunk_loc in self.map_file.chunk_offsets and chunk_loc not in self.removed
+        )
+
+    def read(self, chunk_loc):
+        types, variants = self.map_file.read_chunk(chunk_loc)
+        return self.grid.make_chunk(types.translate(self.type_table), variants)
+
+    def work(self):
+        while True:
+            chunk_loc = self.requests.get()
+            if chunk_loc is None:
+                return
+            self.results.put((chunk_loc, self.read(chunk_loc)))
+
+    def add(self, chunk_loc, chunk):
+        self.grid.chunks[chunk_loc] = chunk
+        self.recent[chunk_loc] = None
+
+    def load(self, chunk_loc):
+        # Reads a chunk that isn't in the grid yet on this thread, None if it
+        # isn't in the file
+        if not self.on_disk(chunk_loc):
+            return None
+
+        chunk = self.read(chunk_loc)
+        self.add(chunk_loc, chunk)
+        return chunk
+
+    def ready(self, chunk_loc):
+        # Whether the grid has everything of the chunk there is, asks the
+        # loader thread for it when it doesn't
+        if chunk_loc in self.grid.chunks or not self.on_disk(chunk_loc):
+            return True
+
+        self.request(chunk_loc)
+        return False
+
+    def request(self, chunk_loc):
+        if chunk_loc not in self.pending:
+            self.pending.add(chunk_loc)
+            self.requests.put(chunk_loc)
+
+    def load_all(self):
+        for chunk_loc in self.map_file.chunk_offsets:
+            self.grid.load(chunk_loc)
+
+    def pin(self, chunk_loc):
+        self.recent.pop(chunk_loc, None)
+
+    def update(self, chunk_locs):
+        # Takes the chunks that should be in memory, most important last.
+        # Returns the chunks evicted to stay within capacity.
+        while True:
+            try:
+                chunk_loc, chunk = self.results.get_nowait()
+            except queue.Empty:
+                break
+            self.pending.discard(chunk_loc)
+            # It may have been loaded synchronously or edited meanwhile
+            if chunk_loc not in self.grid.chunks and self.on_disk(chunk_loc):
+                self.add(chunk_loc, chunk)
+
+        for chunk_loc in chunk_locs:
+            if chunk_loc in self.recent:
+                self.recent.move_to_end(chunk_loc)
+            elif chunk_loc not in self.grid.chunks and self.on_disk(chunk_loc):
+                self.request(chunk_loc)
+
+        wanted = set(chunk_locs)
+        evicted = []
+        while len(self.recent) > self.capacity:
+            chunk_loc = next(iter(self.recent))
+            # Everything after it is in view as well
+            if chunk_loc in wanted:
+                break
+            del self.recent[chunk_loc]
+            del self.grid.chunks[chunk_loc]
+            evicted.append(chunk_loc)
+
+        return evicted
+
+    def close(self):
+        # The chunks in memory stay in the grid
+        self.requests.put(None)
+        self.worker.join()
+        self.map_file.close()
+        self.grid.stream = None
@@ -0,0 +1,208 @@
+# Number of tiles per side of a storage (and pre-rendered) chunk
+CHUNK_SIZE = 16
+CHUNK_AREA = CHUNK_SIZE * CHUNK_SIZE
+
+# Type id 0 marks an empty cell
+EMPTY = 0
+
+
+class TileChunk:
+    __slots__ = ("types", "variants", "solid", "count")
+
+    def __init__(self, types=None, variants=None, solid=None) -> None:
+        # One byte per cell, indexed by y * CHUNK_SIZE + x inside the chunk
+        self.types = types if types is not None else bytearray(CHUNK_AREA)
+        self.variants = variants if variants is not None else bytearray(CHUNK_AREA)
+        # 1 where the cell holds a solid tile type, kept in sync by TileGrid
+        self.solid = solid if solid is not None else bytearray(CHUNK_AREA)
+        self.count = CHUNK_AREA - self.types.count(EMPTY)
+
+    def copy(self):
+        return TileChunk(
+            bytearray(self.types), bytearray(self.variants), bytearray(self.solid)
+        )
+
+
+# Cells are stored densely in fixed-size chunks of bytes, and chunks are only
+# allocated where tiles exist, so maps can grow unbounded in any direction
+# without paying for the empty space between tiles
+class TileGrid:
+    def __init__(self) -> None:
+        # The chunks in memory. While streaming, chunks of the map file that
+        # aren't loaded yet are missing from it, see load.
+        self.chunks = {}
+        # Set while the chunks are streamed from a binary map, see
+        # streaming.ChunkStream
+        self.stream = None
+        self.type_names = [None]
+        self.type_ids = {}
+        self.solid_types = frozenset()
+        # Maps a type id byte to 1 if the type is solid, for bytes.translate
+        self.solid_table = bytes(256)
+
+    def __len__(self):
+        return sum(chunk.count for chunk in self.chunks.values())
+
+    def clear(self):
+        self.chunks = {}
+
+    def loaded(self, chunk_loc):
+        # The chunk if it is in memory, None otherwise
+        return self.chunks.get(chunk_loc)
+
+    def load(self, chunk_loc):
+        # The chunk, read from the streamed map right away if it isn't in
+        # memory yet, so physics and edits never see a hole where the loader
+        # thread hasn't got to. None if there are no tiles there.
+        chunk = self.chunks.get(chunk_loc)
+        if chunk is None and self.stream is not None:
+            chunk = self.stream.load(chunk_loc)
+
+        return chunk
+
+    def drop(self, chunk_loc):
+        # Removes a chunk emptied by edits
+        del self.chunks[chunk_loc]
+        if self.stream is not None:
+            self.stream.removed.add(chunk_loc)
+
+    def type_id(self, tile_type):
+        if tile_type not in self.type_ids:
+            self.type_ids[tile_type] = len(self.type_names)
+            self.type_names.append(tile_type)
+
+        return self.type_ids[tile_type]
+
+    def type_ids_of(self, tile_types):
+        return frozenset(self.type_id(tile_type) for tile_type in tile_types)
+
+    def set_solid_types(self, type_ids):
+        self.solid_types = frozenset(type_ids)
+        self.solid_table = bytes(int(i in self.solid_types) for i in range(256))
+        for chunk in self.chunks.values():
+            chunk.solid = bytearray(chunk.types.translate(self.solid_table))
+
+    def make_chunk(self, types, variants):
+        types = bytearray(types)
+        return TileChunk(
+            types, bytearray(variants), bytearray(types.translate(self.solid_table))
+        )
+
+    def get(self, x, y):
+        chunk = self.load((x // CHUNK_SIZE, y // CHUNK_SIZE))
+        if chunk is None:
+            return EMPTY, 0
+
+        i = (y % CHUNK_SIZE) * CHUNK_SIZE + x % CHUNK_SIZE
+        return chunk.types[i], chunk.variants[i]
+
+    def type_at(self, x, y):
+        chunk = self.load((x // CHUNK_SIZE, y // CHUNK_SIZE))
+        if chunk is None:
+            return EMPTY
+
+        return chunk.types[(y % CHUNK_SIZE) * CHUNK_SIZE + x % CHUNK_SIZE]
+
+    def solid_at(self, x, y):
+        chunk = self.load((x // CHUNK_SIZE, y // CHUNK_SIZE))
+        if chunk is None:
+            return 0
+
+        return chunk.solid[(y % CHUNK_SIZE) * CHUNK_SIZE + x % CHUNK_SIZE]
+
+    def set(self, x, y, type_id, variant):
+        # Returns whether the cell changed
+        chunk_loc = (x // CHUNK_SIZE, y // CHUNK_SIZE)
+        chunk = self.load(chunk_loc)
+        if chunk is None:
+            if type_id == EMPTY:
+                return False
+            chunk = self.chunks[chunk_loc] = TileChunk()
+
+        i = (y % CHUNK_SIZE) * CHUNK_SIZE + x % CHUNK_SIZE
+        old_type = chunk.types[i]
+        if old_type == type_id and (type_id == EMPTY or chunk.variants[i] == variant):
+            return False
+
+        if old_type == EMPTY:
+            chunk.count += 1
+        elif type_id == EMPTY:
+            chunk.count -= 1
+            variant = 0
+
+        chunk.types[i] = type_id
+        chunk.variants[i] = variant
+        chunk.solid[i] = type_id in self.solid_types
+        if not chunk.count:
+            self.drop(chunk_loc)
+
+        return True
+
+    def remove(self, x, y):
+        return self.set(x, y, EMPTY, 0)
+
+    def set_cells(self, cells, type_id, variant):
+        # set for many (x, y) cells at once. Returns (x, y, old type id, old
+        # variant) for every cell that changed.
+        if type_id == EMPTY:
+            variant = 0
+        solid = type_id in self.solid_types
+        chunks = self.chunks
+        touched = set()
+        changed = []
+        chunk_loc = chunk = None
+        for x, y in cells:
+            loc = (x // CHUNK_SIZE, y // CHUNK_SIZE)
+            if loc != chunk_loc:
+                chunk_loc = loc
+                chunk = self.load(loc)
+                if chunk is None and type_id != EMPTY:
+                    chunk = chunks[loc] = TileChunk()
+                touched.add(loc)
+            if chunk is None:
+                continue
+
+            i = (y % CHUNK_SIZE) * CHUNK_SIZE + x % CHUNK_SIZE
+            old_type = chunk.types[i]
+            old_variant = chunk.variants[i]
+            if old_type == type_id and (type_id == EMPTY or old_variant == variant):
+                continue
+
+            if old_type == EMPTY:
+                chunk.count += 1
+            elif type_id == EMPTY:
+                chunk.count -= 1
+            chunk.types[i] = type_id
+            chunk.variants[i] = variant
+            chunk.solid[i] = solid
+            changed.append((x, y, old_type, old_variant))
+
+        for loc in touched:
+            chunk = chunks.get(loc)
+            if chunk is not None and not chunk.count:
+                self.drop(loc)
+
+        return changed
+
+    def chunk_items(self, chunk_loc):
+        # Tiles of a chunk in memory, see load
+        chunk = self.chunks.get(chunk_loc)
+        if chunk is None:
+            return
+
+        base_x = chunk_loc[0] * CHUNK_SIZE
+        base_y = chunk_loc[1] * CHUNK_SIZE
+        types = chunk.types
+        variants = chunk.variants
+        for i in range(CHUNK_AREA):
+            if types[i]:
+                yield (
+                    base_x + i % CHUNK_SIZE,
+                    base_y + i // CHUNK_SIZE,
+                    types[i],
+                    variants[i],
+                )
+
+    def items(self):
+        for chunk_loc in list(self.chunks):
+            yield from self.chunk_items(chunk_loc)
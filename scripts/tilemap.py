@@ -1,12 +1,28 @@
+import collections
 import itertools
 import json
 
+import numpy as np
 import pygame
 from pygame.math import Vector2
 
+from scripts import mapfile
+from scripts.mapfile import MAP_EXT, MapFile
+from scripts.profiler import profiler
+from scripts.spatial import SpatialHash
+from scripts.streaming import ChunkStream
+from scripts.tilegrid import CHUNK_AREA, CHUNK_SIZE, EMPTY, TileGrid
+from scripts.utils import make_outline
+
+# Most cells a flood fill may cover, larger regions are left untouched
+FLOOD_LIMIT = 100000
+# Chunk surfaces kept rendered, about ten screens' worth at 256 KB each. The
+# ones out of view for longest are dropped first.
+CHUNK_CACHE_SIZE = 64
 NEIGHBOR_OFFSETS = list(itertools.product([-1, 0, 1], repeat=2))
 PHYSICS_TILES = {"grass", "stone"}
 AUTOTILE_TYPES = {"grass", "stone"}
+SPAWNER_IDS = [(mapfile.SPAWNER_TYPE, 0), (mapfile.SPAWNER_TYPE, 1)]
 AUTOTILE_MAP = {
     # based on neighbour tiles we set the correct variant
     tuple(sorted([(1, 0), (0, 1)])): 0,
@@ -19,93 +35,459 @@ AUTOTILE_MAP = {
     tuple(sorted([(1, 0), (0, -1), (0, 1)])): 7,
     tuple(sorted([(1, 0), (-1, 0), (0, 1), (0, -1)])): 8,
 }
+AUTOTILE_BITS = {(1, 0): 1, (-1, 0): 2, (0, -1): 4, (0, 1): 8}
+# AUTOTILE_MAP indexed by a bitmask of the matching neighbours instead, -1
+# where the variant is left as it is
+AUTOTILE_TABLE = np.full(16, -1, dtype=np.int16)
+for neighbours, variant in AUTOTILE_MAP.items():
+    AUTOTILE_TABLE[sum(AUTOTILE_BITS[shift] for shift in neighbours)] = variant
 
 
 class Tilemap:
     def __init__(self, game, tile_size=16):
         self.game = game
         self.tile_size = tile_size
-        self.tilemap = {}
-        self.offgrid_tiles = []
+        self.grid = TileGrid()
+        self.physics_ids = self.grid.type_ids_of(PHYSICS_TILES)
+        self.autotile_ids = self.grid.type_ids_of(AUTOTILE_TYPES)
+        self.autotile_lut = np.zeros(256, dtype=bool)
+        self.autotile_lut[list(self.autotile_ids)] = True
+        self.grid.set_solid_types(self.physics_ids)
+        # Collision rects of solid tiles, built once per cell and shared by
+        # every query so physics doesn't allocate a Rect per tile per frame
+        self.rect_cache = {}
+        self.offgrid = SpatialHash(CHUNK_SIZE * tile_size)
+        # Pre-rendered chunk surfaces keyed by chunk coordinates, a None value
+        # marks a chunk with nothing to draw. Ordered from least to most
+        # recently drawn, see render.
+        self.chunk_cache = collections.OrderedDict()
+        # Outlines of the cached chunks, see utils.outline, dropped along with
+        # their chunk surfaces
+        self.outline_cache = {}
+        # Set while the grid is streamed from a binary map, see load
+        self.stream = None
+        # Binary map the grid was last streamed from, see resume_stream
+        self.stream_path = None
+        # Cells whose type changed since the last update_autotile, which has
+        # to autotile them and their neighbours
+        self.autotile_dirty = set()
+        # Told about every edit when set, see journal.EditJournal
+        self.journal = None
+        # Off-grid keys of the spawners listed in the binary map just loaded,
+        # see extract_spawners
+        self.spawner_keys = None
+        # Bumped whenever anything drawn by render may have changed
+        self.version = 0
+
+    def chunk_px(self):
+        return CHUNK_SIZE * self.tile_size
+
+    def invalidate_chunk(self, chunk_loc):
+        self.version += 1
+        self.chunk_cache.pop(chunk_loc, None)
+        self.outline_cache.pop(chunk_loc, None)
+
+    def invalidate_area(self, rect):
+        chunk_px = self.chunk_px()
+        for cx in range(rect.left // chunk_px, (rect.right - 1) // chunk_px + 1):
+            for cy in range(rect.top // chunk_px, (rect.bottom - 1) // chunk_px + 1):
+                self.invalidate_chunk((cx, cy))
+
+    def get_tile(self, pos):
+        type_id, variant = self.grid.get(pos[0], pos[1])
+        if type_id != EMPTY:
+            return {
+                "type": self.grid.type_names[type_id],
+                "variant": variant,
+                "pos": [pos[0], pos[1]],
+            }
+
+    def variant_changed(self, pos):
+        chunk_loc = (pos[0] // CHUNK_SIZE, pos[1] // CHUNK_SIZE)
+        self.invalidate_chunk(chunk_loc)
+        if self.stream:
+            self.stream.pin(chunk_loc)
+
+    def tile_changed(self, pos):
+        self.variant_changed(pos)
+        self.autotile_dirty.add((pos[0], pos[1]))
+
+    def write_cell(self, x, y, type_id, variant):
+        # Returns whether the cell changed
+        old = self.grid.get(x, y)
+        if not self.grid.set(x, y, type_id, variant):
+            return False
+
+        if self.journal is not None:
+            self.journal.cell_changed(x, y, old, self.grid.get(x, y))
+        return True
+
+    def set_tile(self, pos, tile_type, variant):
+        # Autotiled types are written with the variant update_autotile would
+        # give them, so holding a brush over a cell doesn't change it back
+        # and forth every frame
+        type_id = self.grid.type_id(tile_type)
+        if type_id in self.autotile_ids:
+            variant = self.autotile_variant(pos[0], pos[1], type_id, variant)
+        if self.write_cell(pos[0], pos[1], type_id, variant):
+            self.tile_changed(pos)
+
+    def autotile_variant(self, x, y, type_id, variant):
+        # Variant autotiling picks for a cell of type_id at x, y, variant
+        # where it leaves it as it is
+        mask = sum(
+            bit
+            for (dx, dy), bit in AUTOTILE_BITS.items()
+            if self.grid.type_at(x + dx, y + dy) == type_id
+        )
+        new = int(AUTOTILE_TABLE[mask])
+        return variant if new < 0 else new
+
+    def remove_tile(self, pos):
+        if self.write_cell(pos[0], pos[1], EMPTY, 0):
+            self.tile_changed(pos)
+
+    def write_cells(self, cells, type_id, variant):
+        # write_cell for many cells, with the render caches and autotiling
+        # updated once per chunk instead of once per cell. Returns the number
+        # of cells that changed.
+        changes = self.grid.set_cells(cells, type_id, variant)
+        if self.journal is not None:
+            if type_id == EMPTY:
+                variant = 0
+            self.journal.cells_changed(
+                [
+                    value
+                    for x, y, old_type, old_variant in changes
+                    for value in (x, y, old_type, old_variant, type_id, variant)
+                ]
+            )
+        changed = [(x, y) for x, y, _, _ in changes]
+
+        for chunk_loc in {(x // CHUNK_SIZE, y // CHUNK_SIZE) for x, y in changed}:
+            self.invalidate_chunk(chunk_loc)
+            if self.stream:
+                self.stream.pin(chunk_loc)
+        self.autotile_dirty.update(changed)
+
+        return len(changed)
+
+    def fill_rect(self, start, end, tile_type, variant):
+        # Fills the cells between two corners, both included
+        left, right = sorted((start[0], end[0]))
+        top, bottom = sorted((start[1], end[1]))
+        return self.write_cells(
+            itertools.product(range(left, right + 1), range(top, bottom + 1)),
+            self.grid.type_id(tile_type),
+            variant,
+        )
+
+    def erase_rect(self, start, end):
+        # Removes the grid cells between two corners and the off-grid tiles
+        # that overlap them
+        left, right = sorted((start[0], end[0]))
+        top, bottom = sorted((start[1], end[1]))
+        for key in self.offgrid.query(
+            pygame.Rect(
+                left * self.tile_size,
+                top * self.tile_size,
+                (right - left + 1) * self.tile_size,
+                (bottom - top + 1) * self.tile_size,
+            )
+        ):
+            self.remove_offgrid(key)
+
+        return self.write_cells(
+            itertools.product(range(left, right + 1), range(top, bottom + 1)),
+            EMPTY,
+            0,
+        )
+
+    def flood_fill(self, pos, tile_type, variant, limit=FLOOD_LIMIT):
+        # Fills the region of cells connected to pos that hold the same type
+        # as it. A region of more than limit cells, like the open space around
+        # the map, is left as it is and 0 is returned.
+        type_at = self.grid.type_at
+        target = type_at(pos[0], pos[1])
+        region = {(pos[0], pos[1])}
+        frontier = [(pos[0], pos[1])]
+        while frontier:
+            x, y = frontier.pop()
+            for cell in ((x + 1, y), (x - 1, y), (x, y + 1), (x, y - 1)):
+                if cell not in region and type_at(cell[0], cell[1]) == target:
+                    if len(region) == limit:
+                        return 0
+                    region.add(cell)
+                    frontier.append(cell)
+
+        return self.write_cells(region, self.grid.type_id(tile_type), variant)
+
+    def tiles(self):
+        type_names = self.grid.type_names
+        for x, y, type_id, variant in self.grid.items():
+            yield {"type": type_names[type_id], "variant": variant, "pos": [x, y]}
+
+    @property
+    def offgrid_tiles(self):
+        return list(self.offgrid)
+
+    def offgrid_rect(self, tile):
+        # Tiles without an image (e.g. spawners in game) are never drawn
+        if tile["type"] not in self.game.assets:
+            return pygame.Rect(int(tile["pos"][0]), int(tile["pos"][1]), 0, 0)
+
+        img = self.game.assets[tile["type"]][tile["variant"]]
+        return pygame.Rect(
+            int(tile["pos"][0]), int(tile["pos"][1]), img.get_width(), img.get_height()
+        )
+
+    def add_offgrid(self, tile):
+        rect = self.offgrid_rect(tile)
+        self.invalidate_area(rect)
+        key = self.offgrid.insert(tile, rect)
+        if self.journal is not None:
+            self.journal.offgrid_added(key, tile)
+        return key
+
+    def remove_offgrid(self, key):
+        self.invalidate_area(self.offgrid.rect(key))
+        tile = self.offgrid.remove(key)
+        if self.journal is not None:
+            self.journal.offgrid_removed(key, tile)
+        return tile
+
+    def offgrid_at(self, pos):
+        return self.offgrid.query_point(pos)
 
     def extract(self, id_pairs, keep=False):
         matches = []
-        for tile in self.offgrid_tiles.copy():
+        for key, tile in self.offgrid.items():
             if (tile["type"], tile["variant"]) in id_pairs:
                 matches.append(tile.copy())
                 if not keep:
-                    self.offgrid_tiles.remove(tile)
-        for loc in self.tilemap:
-            tile = self.tilemap[loc]
+                    self.remove_offgrid(key)
+        for tile in self.tiles():
             if (tile["type"], tile["variant"]) in id_pairs:
                 matches.append(tile.copy())
                 matches[-1]["pos"] = matches[-1]["pos"].copy()
                 matches[-1]["pos"][0] *= self.tile_size
                 matches[-1]["pos"][1] *= self.tile_size
                 if not keep:
-                    del self.tilemap[loc]
+                    self.remove_tile(tile["pos"])
 
         return matches
 
+    def extract_spawners(self):
+        # Takes every spawner tile out of the map. A binary map lists its
+        # off-grid spawners, so then only grid tiles are searched, and only
+        # when there are any spawners on the grid.
+        if self.spawner_keys is None:
+            return self.extract(SPAWNER_IDS)
+
+        spawners = [
+            self.remove_offgrid(key).copy()
+            for key in self.spawner_keys
+            if key in self.offgrid.entries
+        ]
+        self.spawner_keys = None
+        type_id = self.grid.type_ids.get(mapfile.SPAWNER_TYPE)
+        if type_id is not None and any(
+            type_id in chunk.types for chunk in self.grid.chunks.values()
+        ):
+            spawners += self.extract(SPAWNER_IDS)
+
+        return spawners
+
     def tiles_around(self, pos):
         tiles = []
         tile_loc = (int(pos[0] // self.tile_size), int(pos[1] // self.tile_size))
         for offset in NEIGHBOR_OFFSETS:
-            check_loc = (
-                str(tile_loc[0] + offset[0]) + ";" + str(tile_loc[1] + offset[1])
-            )
-            if check_loc in self.tilemap:
-                tiles.append(self.tilemap[check_loc])
+            tile = self.get_tile((tile_loc[0] + offset[0], tile_loc[1] + offset[1]))
+            if tile:
+                tiles.append(tile)
 
         return tiles
 
+    def tile_rect(self, x, y):
+        rect = self.rect_cache.get((x, y))
+        if rect is None:
+            rect = self.rect_cache[(x, y)] = pygame.Rect(
+                x * self.tile_size, y * self.tile_size, self.tile_size, self.tile_size
+            )
+
+        return rect
+
+    def is_solid(self, x, y):
+        return self.grid.solid_at(x, y)
+
     def physics_rects_around(self, pos):
+        # The returned rects are shared, callers must not modify them
         rects = []
-        for tile in self.tiles_around(pos):
-            if tile["type"] in PHYSICS_TILES:
-                rects.append(
-                    pygame.Rect(
-                        tile["pos"][0] * self.tile_size,
-                        tile["pos"][1] * self.tile_size,
-                        self.tile_size,
-                        self.tile_size,
-                    )
-                )
+        tile_x = int(pos[0] // self.tile_size)
+        tile_y = int(pos[1] // self.tile_size)
+        local_x = tile_x % CHUNK_SIZE
+        local_y = tile_y % CHUNK_SIZE
+        if 0 < local_x < CHUNK_SIZE - 1 and 0 < local_y < CHUNK_SIZE - 1:
+            # The whole neighbourhood sits in one chunk, test its bitmap directly
+            chunk = self.grid.load((tile_x // CHUNK_SIZE, tile_y // CHUNK_SIZE))
+            if chunk is None:
+                return rects
+
+            solid = chunk.solid
+            center = local_y * CHUNK_SIZE + local_x
+            for offset in NEIGHBOR_OFFSETS:
+                if solid[center + offset[1] * CHUNK_SIZE + offset[0]]:
+                    rects.append(self.tile_rect(tile_x + offset[0], tile_y + offset[1]))
+        else:
+            solid_at = self.grid.solid_at
+            for offset in NEIGHBOR_OFFSETS:
+                x = tile_x + offset[0]
+                y = tile_y + offset[1]
+                if solid_at(x, y):
+                    rects.append(self.tile_rect(x, y))
 
         return rects
 
-    def render(self, surf, offset=(0, 0)):
-        for tile in self.offgrid_tiles:
+    def solid_check_many(self, points):
+        # solid_check for an (n, 2) array of points
+        tiles = np.floor_divide(points, self.tile_size).astype(np.int64)
+        return self.solid_many(tiles[:, 0], tiles[:, 1])
+
+    def solid_many(self, xs, ys):
+        # is_solid for arrays of tile coordinates, one bitmap gather per chunk
+        if not len(xs):
+            return np.zeros(0, dtype=bool)
+
+        chunk_xs = xs // CHUNK_SIZE
+        chunk_ys = ys // CHUNK_SIZE
+        cells = (ys - chunk_ys * CHUNK_SIZE) * CHUNK_SIZE + xs - chunk_xs * CHUNK_SIZE
+
+        low_x = int(chunk_xs.min())
+        low_y = int(chunk_ys.min())
+        span = int(chunk_xs.max()) - low_x + 1
+        box = span * (int(chunk_ys.max()) - low_y + 1)
+        if box == 1:
+            # Usually every tile sits in the same chunk
+            chunk = self.grid.load((low_x, low_y))
+            if chunk is None:
+                return np.zeros(len(xs), dtype=bool)
+            bitmap = np.frombuffer(chunk.solid, dtype=np.uint8, count=CHUNK_AREA)
+            return bitmap[cells] != 0
+
+        # Number the chunks within the box around them, to find the distinct
+        # ones and stack their bitmaps
+        chunk_ids = (chunk_ys - low_y) * span + chunk_xs - low_x
+        if box <= 4 * len(xs):
+            present = np.zeros(box, dtype=bool)
+            present[chunk_ids] = True
+            unique_ids = np.flatnonzero(present)
+            index = np.zeros(box, dtype=np.intp)
+            index[unique_ids] = np.arange(len(unique_ids))
+            inverse = index[chunk_ids]
+        else:
+            unique_ids, inverse = np.unique(chunk_ids, return_inverse=True)
+
+        bitmaps = np.zeros((len(unique_ids), CHUNK_AREA), dtype=np.uint8)
+        for i, chunk_id in enumerate(unique_ids.tolist()):
+            chunk = self.grid.load((low_x + chunk_id % span, low_y + chunk_id // span))
+            if chunk is not None:
+                bitmaps[i] = np.frombuffer(
+                    chunk.solid, dtype=np.uint8, count=CHUNK_AREA
+                )
+
+        return bitmaps.ravel()[inverse * CHUNK_AREA + cells] != 0
+
+    def render_chunk(self, chunk_loc):
+        chunk_px = self.chunk_px()
+        chunk_rect = pygame.Rect(
+            chunk_loc[0] * chunk_px, chunk_loc[1] * chunk_px, chunk_px, chunk_px
+        )
+        surf = pygame.Surface(chunk_rect.size, pygame.SRCALPHA)
+        empty = True
+
+        # Off-grid tiles go first so that grid tiles are drawn over them, the
+        # same order the whole map was drawn in before chunking
+        for key in self.offgrid.query(chunk_rect):
+            tile = self.offgrid.get(key)
             surf.blit(
                 self.game.assets[tile["type"]][tile["variant"]],
-                (tile["pos"][0] - offset[0], tile["pos"][1] - offset[1]),
+                (
+                    int(tile["pos"][0]) - chunk_rect.x,
+                    int(tile["pos"][1]) - chunk_rect.y,
+                ),
+            )
+            empty = False
+
+        type_names = self.grid.type_names
+        for x, y, type_id, variant in self.grid.chunk_items(chunk_loc):
+            surf.blit(
+                self.game.assets[type_names[type_id]][variant],
+                (x * self.tile_size - chunk_rect.x, y * self.tile_size - chunk_rect.y),
             )
+            empty = False
 
-        for x in range(
-            offset[0] // self.tile_size,
-            (offset[0] + surf.get_width()) // self.tile_size + 1,
+        return None if empty else surf
+
+    def render(self, surf, offset=(0, 0), outline_only=False):
+        chunk_px = self.chunk_px()
+        blits = []
+        for cx in range(
+            offset[0] // chunk_px, (offset[0] + surf.get_width()) // chunk_px + 1
         ):
-            for y in range(
-                offset[1] // self.tile_size,
-                (offset[1] + surf.get_height()) // self.tile_size + 1,
+            for cy in range(
+                offset[1] // chunk_px, (offset[1] + surf.get_height()) // chunk_px + 1
             ):
-                loc = f"{x};{y}"
-                if loc in self.tilemap:
-                    tile = self.tilemap[loc]
-                    surf.blit(
-                        self.game.assets[tile["type"]][tile["variant"]],
-                        (
-                            tile["pos"][0] * self.tile_size - offset[0],
-                            tile["pos"][1] * self.tile_size - offset[1],
-                        ),
+                chunk_surf = self.chunk_cache.get((cx, cy), False)
+                if chunk_surf is False:
+                    # A streamed chunk still on its way is left out of this
+                    # frame rather than read on the main thread
+                    if self.stream and not self.stream.ready((cx, cy)):
+                        continue
+                    chunk_surf = self.chunk_cache[(cx, cy)] = self.render_chunk(
+                        (cx, cy)
+                    )
+                else:
+                    self.chunk_cache.move_to_end((cx, cy))
+                if not chunk_surf:
+                    continue
+
+                pos = (cx * chunk_px - offset[0], cy * chunk_px - offset[1])
+                if outline_only:
+                    if (cx, cy) not in self.outline_cache:
+                        self.outline_cache[(cx, cy)] = make_outline(chunk_surf)
+                    blits.append(
+                        (self.outline_cache[(cx, cy)], (pos[0] - 1, pos[1] - 1))
                     )
+                else:
+                    blits.append((chunk_surf, pos))
+                    chunk = self.grid.loaded((cx, cy))
+                    if chunk is not None:
+                        profiler.count("tiles", chunk.count)
+
+        surf.blits(blits, doreturn=False)
+        profiler.count("blits", len(blits))
+
+        # Outlines go with the chunk surfaces they were made from
+        while len(self.chunk_cache) > CHUNK_CACHE_SIZE:
+            chunk_loc, _ = self.chunk_cache.popitem(last=False)
+            self.outline_cache.pop(chunk_loc, None)
 
     def save(self, path):
+        if self.stream:
+            self.stream.load_all()
+
+        if path.endswith(MAP_EXT):
+            mapfile.write(path, self.tile_size, self.grid, self.offgrid_tiles)
+            return
+
         try:
             fout = open(path, "w")
             json.dump(
                 {
-                    "tilemap": self.tilemap,
+                    "tilemap": {
+                        f"{tile['pos'][0]};{tile['pos'][1]}": tile
+                        for tile in self.tiles()
+                    },
                     "tile_size": self.tile_size,
                     "offgrid": self.offgrid_tiles,
                 },
@@ -116,7 +498,17 @@ class Tilemap:
             if fout:
                 fout.close()
 
-    def load(self, path):
+    def load(self, path, stream=False):
+        # With stream, chunks of a binary map are only read when they come
+        # into view, see focus. Until then extract and tiles only see the
+        # loaded chunks, so spawners have to be off-grid. JSON maps are
+        # always loaded whole.
+        self.stop_stream()
+        self.stream_path = None
+        if path.endswith(MAP_EXT):
+            self.load_binary(path, stream)
+            return
+
         try:
             fin = open(path)
             map_data = json.load(fin)
@@ -124,31 +516,204 @@ class Tilemap:
             if fin:
                 fin.close()
 
-        self.tilemap = map_data["tilemap"]
-        self.tile_size = map_data["tile_size"]
-        self.offgrid_tiles = map_data["offgrid"]
+        self.grid.clear()
+        for tile in map_data["tilemap"].values():
+            self.grid.set(
+                tile["pos"][0],
+                tile["pos"][1],
+                self.grid.type_id(tile["type"]),
+                tile["variant"],
+            )
+        self.reset(map_data["tile_size"], map_data["offgrid"])
 
-    def autotile(self):
-        for loc, tile in self.tilemap.items():
-            neighbours = set()
-            for shift in {(1, 0), (-1, 0), (0, -1), (0, 1)}:
-                check_loc = (
-                    str(tile["pos"][0] + shift[0])
-                    + ";"
-                    + str(tile["pos"][1] + shift[1])
+    def load_binary(self, path, stream=False):
+        if stream:
+            map_file = MapFile(path)
+            self.grid.clear()
+            self.stream = ChunkStream(map_file, self.grid)
+            self.stream_path = path
+            self.reset(map_file.tile_size, map_file.offgrid_tiles())
+            # reset inserts the off-grid tiles in order into a new hash, so
+            # their keys are their indices in the map's off-grid table
+            self.spawner_keys = list(map_file.spawner_indices)
+            return
+
+        # Chunks are copied straight out of the mapped file, no per-tile
+        # objects are created for the grid
+        with MapFile(path) as map_file:
+            type_table = map_file.type_table(self.grid)
+            self.grid.clear()
+            for chunk_loc in map_file.chunk_offsets:
+                types, variants = map_file.read_chunk(chunk_loc)
+                self.grid.chunks[chunk_loc] = self.grid.make_chunk(
+                    types.translate(type_table), variants
                 )
-                if check_loc in self.tilemap:
-                    if self.tilemap[check_loc]["type"] == tile["type"]:
-                        neighbours.add(shift)
+            self.reset(map_file.tile_size, map_file.offgrid_tiles())
+            # Keys as above
+            self.spawner_keys = list(map_file.spawner_indices)
 
-            neighbours = tuple(sorted(neighbours))
-            if tile["type"] in AUTOTILE_TYPES and neighbours in AUTOTILE_MAP:
-                tile["variant"] = AUTOTILE_MAP[neighbours]
+    def stop_stream(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+
+    def resume_stream(self):
+        # Streams the grid from its map again after stop_stream, for a
+        # tilemap that is played again, see World.restore. The chunks are
+        # read back as they come into view, the rest of the tilemap is kept.
+        if self.stream is None and self.stream_path:
+            self.grid.clear()
+            self.stream = ChunkStream(MapFile(self.stream_path), self.grid)
+
+    def focus(self, rect, margin=1):
+        # Streams in the chunks within margin chunks of rect (usually the
+        # camera) and evicts the ones that haven't been near it for longest
+        if not self.stream:
+            return
+
+        chunk_px = self.chunk_px()
+        left = int(rect.left // chunk_px) - margin
+        top = int(rect.top // chunk_px) - margin
+        right = int((rect.right - 1) // chunk_px) + margin
+        bottom = int((rect.bottom - 1) // chunk_px) + margin
+        for chunk_loc in self.stream.update(
+            [(cx, cy) for cx in range(left, right + 1) for cy in range(top, bottom + 1)]
+        ):
+            self.invalidate_chunk(chunk_loc)
+            base_x = chunk_loc[0] * CHUNK_SIZE
+            base_y = chunk_loc[1] * CHUNK_SIZE
+            for y in range(base_y, base_y + CHUNK_SIZE):
+                for x in range(base_x, base_x + CHUNK_SIZE):
+                    self.rect_cache.pop((x, y), None)
+
+    def reset(self, tile_size, offgrid):
+        self.tile_size = tile_size
+        self.rect_cache = {}
+        self.offgrid = SpatialHash(CHUNK_SIZE * self.tile_size)
+        for tile in offgrid:
+            self.offgrid.insert(tile, self.offgrid_rect(tile))
+        self.chunk_cache = collections.OrderedDict()
+        self.outline_cache = {}
+        self.autotile_dirty = set()
+        self.spawner_keys = None
+        self.version += 1
+
+    def type_window(self, chunk_loc):
+        # Type ids of a chunk and of the ring of cells around it
+        size = CHUNK_SIZE
+        window = np.zeros((size + 2, size + 2), dtype=np.uint8)
+        # Rows or columns of the window, and of the chunk they come from, for
+        # the chunks before, at and after chunk_loc
+        spans = (
+            (slice(0, 1), slice(size - 1, size)),
+            (slice(1, size + 1), slice(0, size)),
+            (slice(size + 1, size + 2), slice(0, 1)),
+        )
+        for dy, (window_rows, rows) in enumerate(spans, start=-1):
+            for dx, (window_cols, cols) in enumerate(spans, start=-1):
+                chunk = self.grid.load((chunk_loc[0] + dx, chunk_loc[1] + dy))
+                if chunk is not None:
+                    types = np.frombuffer(chunk.types, dtype=np.uint8)
+                    window[window_rows, window_cols] = types.reshape(size, size)[
+                        rows, cols
+                    ]
+
+        return window
+
+    def autotile_chunk(self, chunk_loc, selected=None):
+        # Autotiles the cells of a chunk, all of them or the ones set in a
+        # CHUNK_SIZE x CHUNK_SIZE bool array
+        chunk = self.grid.load(chunk_loc)
+        if chunk is None:
+            return
+
+        window = self.type_window(chunk_loc)
+        center = window[1:-1, 1:-1]
+        mask = (
+            (window[1:-1, 2:] == center) * 1
+            + (window[1:-1, :-2] == center) * 2
+            + (window[:-2, 1:-1] == center) * 4
+            + (window[2:, 1:-1] == center) * 8
+        )
+        new = AUTOTILE_TABLE[mask.ravel()]
+        new[~self.autotile_lut[center.ravel()]] = -1
+        variants = np.frombuffer(chunk.variants, dtype=np.uint8)
+        change = (new >= 0) & (new != variants)
+        if selected is not None:
+            change &= selected.ravel()
+        indices = np.flatnonzero(change)
+        if not len(indices):
+            return
+
+        if self.journal is not None:
+            x = chunk_loc[0] * CHUNK_SIZE + indices % CHUNK_SIZE
+            y = chunk_loc[1] * CHUNK_SIZE + indices // CHUNK_SIZE
+            types = np.frombuffer(chunk.types, dtype=np.uint8)[indices]
+            self.journal.cells_changed(
+                np.stack((x, y, types, variants[indices], types, new[indices]), axis=1)
+                .ravel()
+                .tolist()
+            )
+        # Writes through to the chunk's bytearray
+        variants[indices] = new[indices]
+        self.variant_changed((chunk_loc[0] * CHUNK_SIZE, chunk_loc[1] * CHUNK_SIZE))
+
+    def update_autotile(self):
+        # Autotiles the cells changed since the last call and their
+        # neighbours. A variant depends on the types around it and never on
+        # their variants, so these cells end up as a full autotile pass would
+        # leave them.
+        if not self.autotile_dirty:
+            return
+
+        cells = np.array(list(self.autotile_dirty), dtype=np.int64)
+        self.autotile_dirty = set()
+        chunk_locs, groups = np.unique(cells // CHUNK_SIZE, axis=0, return_inverse=True)
+        # Cells ordered by chunk, bounds[i]:bounds[i + 1] are in chunk_locs[i]
+        groups = groups.ravel()
+        order = np.argsort(groups, kind="stable")
+        local = (cells % CHUNK_SIZE)[order]
+        bounds = np.searchsorted(groups[order], np.arange(len(chunk_locs) + 1))
+        size = CHUNK_SIZE
+
+        selections = {}
+
+        def select(chunk_loc):
+            if chunk_loc not in selections:
+                selections[chunk_loc] = np.zeros((size, size), dtype=bool)
+            return selections[chunk_loc]
+
+        for group, (cx, cy) in enumerate(chunk_locs.tolist()):
+            members = local[bounds[group] : bounds[group + 1]]
+            # Changed cells grown by one cell in each direction, in a window
+            # with a ring for the neighbouring chunks
+            changed = np.zeros((size + 2, size + 2), dtype=bool)
+            changed[members[:, 1] + 1, members[:, 0] + 1] = True
+            grown = changed.copy()
+            grown[1:] |= changed[:-1]
+            grown[:-1] |= changed[1:]
+            grown[:, 1:] |= changed[:, :-1]
+            grown[:, :-1] |= changed[:, 1:]
+
+            select((cx, cy))[:] |= grown[1:-1, 1:-1]
+            if grown[0].any():
+                select((cx, cy - 1))[size - 1] |= grown[0, 1:-1]
+            if grown[-1].any():
+                select((cx, cy + 1))[0] |= grown[-1, 1:-1]
+            if grown[:, 0].any():
+                select((cx - 1, cy))[:, size - 1] |= grown[1:-1, 0]
+            if grown[:, -1].any():
+                select((cx + 1, cy))[:, 0] |= grown[1:-1, -1]
+
+        for chunk_loc, selected in selections.items():
+            self.autotile_chunk(chunk_loc, selected)
+
+    def autotile(self):
+        self.autotile_dirty = set()
+        for chunk_loc in list(self.grid.chunks):
+            self.autotile_chunk(chunk_loc)
 
     def solid_check(self, pos):
-        x = int(pos[0] // self.tile_size)
-        y = int(pos[1] // self.tile_size)
-        tile_loc = f"{x};{y}"
-        if tile_loc in self.tilemap:
-            if self.tilemap[tile_loc]["type"] in PHYSICS_TILES:
-                return self.tilemap[tile_loc]
+        return self.grid.solid_at(
+            int(pos[0] // self.tile_size), int(pos[1] // self.tile_size)
+        )
@@ -2,11 +2,30 @@ import os
 
 import pygame
 
+from scripts.atlas import Atlas
+from scripts.profiler import profiler
+
 BASE_IMG_PAHT = os.path.join("data", "images")
 
 
+# Packed atlas of every image under BASE_IMG_PAHT, loaded on first use
+_atlas = None
+
+
+def get_atlas():
+    global _atlas
+    if _atlas is None:
+        _atlas = Atlas(BASE_IMG_PAHT)
+
+    return _atlas
+
+
 def load_image(path):
-    img = pygame.image.load(os.path.join(BASE_IMG_PAHT, path)).convert()
+    # A view into the atlas, which is already converted to the display format
+    # when there is one. Without a display (headless simulation) images are
+    # kept in their file format, they are only used for their sizes and frame
+    # counts.
+    img = get_atlas().image(path)
     img.set_colorkey(pygame.Color("black"))
     return img
 
@@ -14,7 +33,7 @@ def load_image(path):
 def load_images(path):
     images = []
     for img_name in sorted(
-        os.listdir(os.path.join(BASE_IMG_PAHT, path)),
+        get_atlas().listdir(path),
         key=lambda el: int(el.split(".")[0]),
     ):
         images.append(load_image(os.path.join(path, img_name)))
@@ -22,16 +41,69 @@ def load_images(path):
     return images
 
 
+# Transformed copies of images, made once and reused on every frame
+_flip_cache = {}
+
+
+def flip_x(img):
+    flipped = _flip_cache.get(img)
+    if flipped is None:
+        flipped = _flip_cache[img] = pygame.transform.flip(img, True, False)
+
+    return flipped
+
+
+# Color of the drop shadow drawn around everything in the foreground
+OUTLINE_COLOR = (0, 0, 0, 180)
+_outline_cache = {}
+
+
+def make_outline(img):
+    # Silhouette of img shifted by one pixel in each of the four directions,
+    # as a surface two pixels larger that is drawn at (x - 1, y - 1). Blending
+    # the four copies here gives the same result as blitting them one by one.
+    silhouette = pygame.mask.from_surface(img).to_surface(
+        setcolor=OUTLINE_COLOR, unsetcolor=(0, 0, 0, 0)
+    )
+    shadow = pygame.Surface(
+        (img.get_width() + 2, img.get_height() + 2), pygame.SRCALPHA
+    )
+    for offset in ((0, 1), (2, 1), (1, 0), (1, 2)):
+        shadow.blit(silhouette, offset)
+
+    return shadow
+
+
+def outline(img):
+    shadow = _outline_cache.get(img)
+    if shadow is None:
+        shadow = _outline_cache[img] = make_outline(img)
+
+    return shadow
+
+
+def draw(surf, img, pos, outline_only=False):
+    profiler.count("blits")
+    if outline_only:
+        surf.blit(outline(img), (pos[0] - 1, pos[1] - 1))
+    else:
+        surf.blit(img, pos)
+
+
 class Animation:
-    def __init__(self, images, img_dur=5, loop=True) -> None:
+    def __init__(self, images, img_dur=5, loop=True, flipped_images=None) -> None:
         self.images = images
+        # Horizontally mirrored frames, baked once and shared by every copy
+        if flipped_images is None:
+            flipped_images = [flip_x(img) for img in images]
+        self.flipped_images = flipped_images
         self.loop = loop
         self.img_duration = img_dur
         self.done = False
         self.frame = 0
 
     def copy(self):
-        return Animation(self.images, self.img_duration, self.loop)
+        return Animation(self.images, self.img_duration, self.loop, self.flipped_images)
 
     def update(self):
         if self.loop:
@@ -41,5 +113,6 @@ class Animation:
             if self.frame >= self.img_duration * len(self.images) - 1:
                 self.done = True
 
-    def img(self):
-        return self.images[int(self.frame / self.img_duration)]
+    def img(self, flip=False):
+        images = self.flipped_images if flip else self.images
+        return images[int(self.frame / self.img_duration)]
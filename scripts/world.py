@@ -0,0 +1,439 @@
+import collections
+import concurrent.futures
+import hashlib
+import math
+import os
+import random
+
+import pygame
+
+from scripts import mapfile
+from scripts.collisions import CollisionManager
+from scripts.entities import Player, Enemy
+from scripts.particles import ParticleSystem
+from scripts.physics import BATCH_MIN, move_entities
+from scripts.projectiles import ProjectileSystem
+from scripts.snapshot import Snapshot
+from scripts.sparks import SparkSystem
+from scripts.tilemap import Tilemap
+from scripts.utils import load_image, load_images, Animation
+
+# Simulation steps per second, independent of the rendering frame rate
+STEP_RATE = 60
+
+# Bits of the input mask passed to World.step. LEFT and RIGHT are held keys,
+# JUMP and DASH are presses that happened since the previous step.
+INPUT_LEFT = 1
+INPUT_RIGHT = 2
+INPUT_JUMP = 4
+INPUT_DASH = 8
+
+MAPS_PATH = os.path.join("data", "maps")
+
+
+def load_assets():
+    return {
+        "decor": load_images(os.path.join("tiles", "decor")),
+        "large_decor": load_images(os.path.join("tiles", "large_decor")),
+        "grass": load_images(os.path.join("tiles", "grass")),
+        "stone": load_images(os.path.join("tiles", "stone")),
+        "player": load_image(os.path.join("entities", "player.png")),
+        "background": load_image("background.png"),
+        "clouds": load_images("clouds"),
+        "player/idle": Animation(
+            load_images(os.path.join("entities", "player", "idle")), img_dur=6
+        ),
+        "player/run": Animation(
+            load_images(os.path.join("entities", "player", "run")), img_dur=4
+        ),
+        "player/jump": Animation(
+            load_images(os.path.join("entities", "player", "jump"))
+        ),
+        "player/slide": Animation(
+            load_images(os.path.join("entities", "player", "slide"))
+        ),
+        "player/wall_slide": Animation(
+            load_images(os.path.join("entities", "player", "wall_slide"))
+        ),
+        "particle/leaf": Animation(
+            load_images(os.path.join("particles", "leaf")), img_dur=20, loop=False
+        ),
+        "particle/particle": Animation(
+            load_images(os.path.join("particles", "particle")),
+            img_dur=6,
+            loop=False,
+        ),
+        "enemy/idle": Animation(
+            load_images(os.path.join("entities", "enemy", "idle")), img_dur=6
+        ),
+        "enemy/run": Animation(
+            load_images(os.path.join("entities", "enemy", "run")), img_dur=4
+        ),
+        "gun": load_image("gun.png"),
+        "projectile": load_image("projectile.png"),
+    }
+
+
+def level_index(maps_path=MAPS_PATH):
+    # Ids of the levels in maps_path, in the order they are played
+    return sorted(
+        int(name.split(".")[0])
+        for name in os.listdir(maps_path)
+        if name.endswith(".json") and name.split(".")[0].isdigit()
+    )
+
+
+class NullSound:
+    def play(self, *args, **kwargs):
+        pass
+
+    def set_volume(self, volume):
+        pass
+
+
+# Everything load_level sets up for a map: the parsed tilemap, with the
+# spawners taken out of it, and where they spawn the player and enemies.
+# Built on the loader thread while the previous level is played. Nothing
+# here changes while the level is played, so restarts reuse it.
+class Level:
+    def __init__(self, world, map_id) -> None:
+        self.map_id = map_id
+        self.tilemap = Tilemap(world, tile_size=16)
+        self.tilemap.load(
+            mapfile.compiled(os.path.join(world.maps_path, f"{map_id}.json")),
+            world.stream,
+        )
+
+        self.leaf_spawners = []
+        for tree in self.tilemap.extract([("large_decor", 2)], keep=True):
+            self.leaf_spawners.append(
+                pygame.Rect(4 + tree["pos"][0], 4 + tree["pos"][1], 23, 13)
+            )
+
+        self.player_pos = None
+        self.enemy_positions = []
+        for spawner in self.tilemap.extract_spawners():
+            if spawner["variant"] == 0:
+                self.player_pos = spawner["pos"]
+            elif spawner["variant"] == 1:
+                self.enemy_positions.append(spawner["pos"])
+
+    def spawn_enemies(self, world):
+        return [Enemy(world, pos, (8, 15)) for pos in self.enemy_positions]
+
+    def discard(self):
+        self.tilemap.stop_stream()
+
+
+# Game state and rules, without any display, audio device or clock. Game
+# renders it, but it can be stepped on its own as fast as the CPU allows.
+class World:
+    def __init__(
+        self,
+        assets=None,
+        sfx=None,
+        level=0,
+        stream=False,
+        batch_physics=True,
+        maps_path=MAPS_PATH,
+        seed=None,
+    ):
+        # Everything random in the simulation comes from rng, so the same
+        # seed and inputs always play out the same, see scripts.replay
+        self.seed = seed if seed is not None else random.getrandbits(32)
+        self.rng = random.Random(self.seed)
+        # Stream level chunks in as the camera gets close, see Tilemap.focus
+        self.stream = stream
+        # Move all enemies at once with move_entities, instead of one by one
+        self.batch_physics = batch_physics
+        self.assets = assets if assets is not None else load_assets()
+        self.sfx = sfx if sfx is not None else collections.defaultdict(NullSound)
+
+        self.player = Player(self, (50, 50), (8, 15))
+        self.particles = ParticleSystem(self)
+        self.sparks = SparkSystem()
+        self.projectiles = ProjectileSystem(self)
+        self.tilemap = Tilemap(self, tile_size=16)
+        # The Level being played, see load_level
+        self.stage = None
+        # Every entity in the level, see load_level. Projectiles are put in
+        # again every step once they moved.
+        self.collisions = CollisionManager()
+
+        self.frame = 0
+        self.screenshake = 0
+        # Enemies killed since the world was made, see scripts.batch
+        self.kills = 0
+        self.maps_path = maps_path
+        self.levels = level_index(maps_path)
+        # Levels being prepared on the loader thread, keyed by map id
+        self.loader = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.preloaded = {}
+        self.level = level
+        self.load_level(self.level)
+
+    def next_level(self):
+        return min(self.level + 1, len(self.levels) - 1)
+
+    def preload(self, map_id):
+        if map_id not in self.preloaded:
+            self.preloaded[map_id] = self.loader.submit(Level, self, map_id)
+
+    def load_level(self, map_id):
+        # Restarting reuses the level being played. Otherwise takes the
+        # preloaded level if there is one, waiting for it if it is still
+        # being built, and loads it here if there is none.
+        if self.stage is not None and self.stage.map_id == map_id:
+            level = self.stage
+        else:
+            future = self.preloaded.pop(map_id, None)
+            level = future.result() if future else Level(self, map_id)
+            self.use_stage(level)
+
+        self.enemies = level.spawn_enemies(self)
+        if level.player_pos is not None:
+            self.player.pos = list(level.player_pos)
+            self.player.prev_pos = list(level.player_pos)
+            self.player.air_time = 0
+
+        self.collisions.clear()
+        self.collisions.add(self.player, "player")
+        for enemy in self.enemies:
+            self.collisions.add(enemy, "enemies")
+
+        self.particles.clear()
+        self.projectiles.clear()
+        self.sparks.clear()
+        self.dead = 0
+        self.transition = -30
+        self.preload_next()
+
+    def use_stage(self, level):
+        if self.stage is not None:
+            self.stage.discard()
+        self.stage = level
+        self.tilemap = level.tilemap
+        self.leaf_spawners = level.leaf_spawners
+
+    def preload_next(self):
+        # Builds the next level on the loader thread, dropping any other
+        # preloaded level
+        next_level = self.next_level()
+        for other_id in list(self.preloaded):
+            if other_id != next_level:
+                self.preloaded.pop(other_id).add_done_callback(
+                    lambda future: future.result().discard()
+                )
+        if next_level != self.stage.map_id:
+            self.preload(next_level)
+
+    def close(self):
+        # Stops the loader thread and the map streams, the world can't load
+        # levels any more afterwards
+        self.loader.shutdown(cancel_futures=True)
+        for future in self.preloaded.values():
+            if not future.cancelled():
+                future.result().discard()
+        self.preloaded = {}
+        self.tilemap.stop_stream()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def snapshot(self):
+        # Costs about 0.1 ms with 300 enemies and 1 ms with 1000, so one can
+        # be taken every step, see snapshot.SnapshotRing
+        return Snapshot(self)
+
+    def restore(self, snapshot):
+        # Puts the world back to how it was when snapshot was taken. The
+        # same snapshot can be restored any number of times.
+        if snapshot.stage is not self.stage:
+            # Taken on another level
+            self.use_stage(snapshot.stage)
+            if self.stream:
+                self.tilemap.resume_stream()
+
+        self.frame = snapshot.frame
+        self.level = snapshot.level
+        self.dead = snapshot.dead
+        self.transition = snapshot.transition
+        self.screenshake = snapshot.screenshake
+        self.kills = snapshot.kills
+        self.rng.setstate(snapshot.rng_getstate())
+
+        self.player.restore(snapshot.player)
+        self.enemies = []
+        for enemy, state in snapshot.enemies:
+            enemy.restore(state)
+            self.enemies.append(enemy)
+
+        self.collisions.clear()
+        self.collisions.add(self.player, "player")
+        for enemy in self.enemies:
+            self.collisions.add(enemy, "enemies")
+
+        self.particles.restore(snapshot.particles)
+        self.sparks.restore(snapshot.sparks)
+        self.projectiles.restore(snapshot.projectiles)
+        self.preload_next()
+
+    def state_hash(self):
+        # Digest of everything a step carries over to the next one
+        digest = hashlib.sha256()
+        digest.update(
+            repr(
+                (
+                    self.frame,
+                    self.level,
+                    self.dead,
+                    self.transition,
+                    self.screenshake,
+                    self.player.state(),
+                    [enemy.state() for enemy in self.enemies],
+                    self.rng.getstate(),
+                )
+            ).encode()
+        )
+        for system, names in (
+            (self.particles, ("pos", "velocity", "frame", "type", "done")),
+            (self.sparks, ("pos", "direction", "speed")),
+            (self.projectiles, ("pos", "direction", "timer")),
+        ):
+            for name in names:
+                digest.update(getattr(system, name)[: system.count].tobytes())
+
+        return digest.hexdigest()
+
+    def kill_enemy(self, enemy):
+        self.enemies.remove(enemy)
+        self.collisions.remove(enemy)
+        self.kills += 1
+
+        self.screenshake = max(16, self.screenshake)
+        self.sfx["hit"].play()
+        center = enemy.rect().center
+        for _ in range(30):
+            angle = self.rng.random() * math.pi * 2
+            speed = self.rng.random() * 5
+            self.sparks.spawn(center, angle, 2 + self.rng.random())
+            self.particles.spawn(
+                "particle",
+                center,
+                velocity=[
+                    math.cos(angle + math.pi) * speed * 0.5,
+                    math.sin(angle + math.pi) * speed * 0.5,
+                ],
+                frame=self.rng.randint(0, 7),
+            )
+        self.sparks.spawn(center, 0, 5 + self.rng.random())
+        self.sparks.spawn(center, math.pi, 5 + self.rng.random())
+
+    def step(self, inputs=0):
+        self.frame += 1
+
+        if inputs & INPUT_JUMP:
+            if self.player.jump():
+                self.sfx["jump"].play()
+        if inputs & INPUT_DASH:
+            self.player.dash()
+
+        self.screenshake = max(0, self.screenshake - 1)
+
+        if not self.enemies:
+            self.transition += 1
+            if self.transition > 30:
+                self.level = self.next_level()
+                self.load_level(self.level)
+        if self.transition < 0:
+            self.transition += 1
+
+        if self.dead:
+            self.dead += 1
+            if self.dead >= 10:
+                self.transition = min(30, self.transition + 1)
+            if self.dead > 40:
+                self.load_level(self.level)
+
+        for rect in self.leaf_spawners:
+            if self.rng.random() * 49999 < rect.width * rect.height:
+                pos = (
+                    rect.x + self.rng.random() * rect.width,
+                    rect.y + self.rng.random() * rect.height,
+                )
+                self.particles.spawn(
+                    "leaf",
+                    pos,
+                    velocity=[-0.1, 0.2],
+                    frame=self.rng.randint(0, 20),
+                )
+
+        if self.batch_physics and len(self.enemies) >= BATCH_MIN:
+            # Enemies don't affect each other while updating, so each phase
+            # can run for all of them before the next
+            movements = [enemy.think(self.tilemap, (0, 0)) for enemy in self.enemies]
+            move_entities(self.tilemap, self.enemies, movements)
+            for enemy, movement in zip(self.enemies, movements):
+                enemy.end_update(movement)
+                self.collisions.move(enemy)
+        else:
+            for enemy in self.enemies:
+                enemy.update(self.tilemap, (0, 0))
+                self.collisions.move(enemy)
+
+        # Dashing through an enemy kills it
+        if abs(self.player.dashing) >= 50:
+            for _, enemy in self.collisions.pairs("player", "enemies"):
+                self.kill_enemy(enemy)
+
+        if not self.dead:
+            self.player.update(
+                self.tilemap,
+                (bool(inputs & INPUT_RIGHT) - bool(inputs & INPUT_LEFT), 0),
+            )
+            self.collisions.move(self.player)
+
+        wall_hits = self.projectiles.update(self.tilemap)
+        for pos, direction in wall_hits:
+            for _ in range(4):
+                self.sparks.spawn(
+                    pos,
+                    self.rng.random() - 0.5 + (math.pi if direction > 0 else 0),
+                    2 + self.rng.random(),
+                )
+        self.projectiles.register(self.collisions)
+        # Projectiles go through a dashing player
+        hits = []
+        if abs(self.player.dashing) < 50:
+            hits = [i for _, i in self.collisions.pairs("player", "projectiles")]
+        if hits:
+            self.projectiles.remove(hits)
+            self.projectiles.register(self.collisions)
+        for _ in hits:
+            self.sfx["hit"].play()
+            self.dead += 1
+            self.screenshake = max(16, self.screenshake)
+            for _ in range(30):
+                angle = self.rng.random() * math.pi * 2
+                speed = self.rng.random() * 5
+                self.sparks.spawn(
+                    self.player.rect().center,
+                    angle,
+                    2 + self.rng.random(),
+                )
+                self.particles.spawn(
+                    "particle",
+                    self.player.rect().center,
+                    velocity=[
+                        math.cos(angle + math.pi) * speed * 0.5,
+                        math.sin(angle + math.pi) * speed * 0.5,
+                    ],
+                    frame=self.rng.randint(0, 7),
+                )
+
+        self.sparks.update()
+
+        self.particles.update()